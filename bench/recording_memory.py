@@ -0,0 +1,49 @@
+# Measures the memory used by archived recordings loaded at startup, comparing
+# the compact Recording type against the previous layout, where every
+# recording was a full RecordingInfo session object.
+# Run with `python bench/recording_memory.py [count]`.
+import os
+import sys
+import tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "ytdvr"))
+import channel as channels
+
+class LegacyRecordingInfo:
+    # The layout of RecordingInfo before Recording was split out of it
+    def __init__(self, platform, channel, title, timestamp, url, filename, chat_filename, in_progress):
+        self.platform = platform
+        self.channel = channel
+        self.title = title
+        self.timestamp = timestamp
+        self.url = url
+        self.filename = filename
+        self.chat_filename = chat_filename
+        self.in_progress = in_progress
+        self._ytdlProcess = None
+        self._chatRecorder = None
+        self._stop = False
+        self._abort = False
+
+def measure(cls, count: int, *extra) -> int:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    # Strings are built separately for each row, like they are when loaded
+    # from the database
+    recordings = [cls(
+        "".join(["You", "tube"]), "channel" + str(i % 50), "Stream title number " + str(i), 1700000000 + i,
+        "https://www.youtube.com/watch?v=" + str(i),
+        "channel" + str(i % 50) + "/2024-01-01 12-00-00 - Stream title number " + str(i) + ".mp4",
+        "channel" + str(i % 50) + "/2024-01-01 12-00-00 - Stream title number " + str(i) + ".txt",
+        *extra) for i in range(count)]
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del recordings
+    return size
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    full = measure(LegacyRecordingInfo, count, False)
+    compact = measure(channels.Recording, count)
+    print(f"Previous:      {full / count:.0f} bytes/recording ({full / 1000000:.1f} MB total)")
+    print(f"Recording:     {compact / count:.0f} bytes/recording ({compact / 1000000:.1f} MB total)")
+    print(f"Reduction:     {(1 - compact / full) * 100:.0f}%")
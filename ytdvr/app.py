@@ -1,14 +1,22 @@
-from quart import Quart, request, send_file, render_template
+from quart import Quart, Response, request, send_file, render_template, redirect
 from typing import Awaitable, Callable, Any
 from urllib.parse import quote
+import asyncio
 import channel as channels
+import clips
+import cluster
 import config
 import datetime
 import json
 import logging
+import math
 import os
-import yt_dlp
-import yt_dlp.options
+import previews
+import profiling
+import ratelimit
+import reconcile
+import tsindex
+import zlib
 
 LOG = logging.getLogger("yt-dvr")
 
@@ -19,10 +27,14 @@ app.config['TEMPLATES_AUTO_RELOAD'] = True
 def formattime(timestamp) -> str: return datetime.datetime.fromtimestamp(timestamp).strftime("%c")
 def formatdate(timestamp) -> str: return datetime.date.fromtimestamp(timestamp).strftime("%x")
 
-create_parser = yt_dlp.options.create_parser
-
+# yt-dlp is imported lazily, since building its option parser is slow and is
+# only needed when converting CLI flags
+_default_opts: dict | None = None
 
 def parse_patched_options(opts):
+    import yt_dlp
+    import yt_dlp.options
+    create_parser = yt_dlp.options.create_parser
     patched_parser = create_parser()
     patched_parser.defaults.update({
         'ignoreerrors': False,
@@ -38,9 +50,14 @@ def parse_patched_options(opts):
     finally:
         yt_dlp.options.create_parser = create_parser
 
-default_opts = parse_patched_options([]).ydl_opts
+def get_default_opts() -> dict:
+    global _default_opts
+    if _default_opts is None: _default_opts = parse_patched_options([]).ydl_opts
+    return _default_opts
 
 def cli_to_api(opts, cli_defaults=False):
+    import yt_dlp
+    default_opts = get_default_opts()
     opts = (yt_dlp.parse_options if cli_defaults else parse_patched_options)(opts).ydl_opts
 
     diff = {k: v for k, v in opts.items() if default_opts[k] != v}
@@ -59,21 +76,36 @@ async def home():
 async def assets(subpath):
     return await send_file("templates/assets/" + subpath, cache_timeout=30)
 
+def _gunzip(path: str) -> bytes:
+    # Logs that are still being written don't have a gzip trailer yet, which
+    # the gzip module refuses to read
+    with open(path, "rb") as file: return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(file.read())
+
 @app.route("/files/<path:subpath>")
 async def file(subpath: str):
-    if os.path.isfile(config.config.saveDir + "/" + subpath):
-        if subpath.endswith(".part"): return await send_file(config.config.saveDir + "/" + subpath, cache_timeout=0, mimetype="video/mpeg-ts", conditional=True)
-        else: return await send_file(config.config.saveDir + "/" + subpath, cache_timeout=86400, mimetype="video/mpeg-ts" if subpath.endswith(".ts") else None, conditional=True)
+    path = config.config.resolve(subpath)
+    if os.path.isfile(path):
+        if subpath.endswith(".part"): return await send_file(path, cache_timeout=0, mimetype="video/mpeg-ts", conditional=True)
+        elif subpath.endswith(".txt.gz"):
+            # Chat logs are stored compressed, and only decompressed for
+            # clients that can't take them as they are
+            if "gzip" in request.accept_encodings:
+                res = await send_file(path, cache_timeout=0, mimetype="text/plain; charset=utf-8")
+                res.headers["Content-Encoding"] = "gzip"
+                res.headers["Vary"] = "Accept-Encoding"
+                return res
+            else: return Response(await asyncio.to_thread(_gunzip, path), mimetype="text/plain; charset=utf-8", headers={"Vary": "Accept-Encoding"})
+        else: return await send_file(path, cache_timeout=86400, mimetype="video/mpeg-ts" if subpath.endswith(".ts") else None, conditional=True)
     else: return (await render_template("404.html", message="The requested file does not exist."), 404)
 
 @app.route("/files/<channel>/<file>.m3u8")
 async def file_m3u8(channel, file):
     path = ""
-    if os.path.isfile(config.config.saveDir + "/" + channel + "/" + file + ".ts"):
+    if os.path.isfile(config.config.resolve(channel + "/" + file + ".ts")):
         path = file + ".ts"
     elif os.path.isfile(config.config.saveDir + "/" + channel + "/" + file + ".ts.part"):
         path = file + ".ts.part"
-    elif os.path.isfile(config.config.saveDir + "/" + channel + "/" + file + ".mp4"):
+    elif os.path.isfile(config.config.resolve(channel + "/" + file + ".mp4")):
         path = file + ".mp4"
     elif os.path.isfile(config.config.saveDir + "/" + channel + "/" + file + ".mp4.part"):
         path = file + ".mp4.part"
@@ -84,10 +116,48 @@ async def file_m3u8(channel, file):
             if video.channel == channel and (video.filename == channel + "/" + path or video.filename + ".part" == channel + "/" + path):
                 if video.in_progress:
                     duration = str(int(datetime.datetime.now().timestamp()) - video.timestamp)
+                    # After a restart, only the latest part is still growing
+                    if video.part > 0:
+                        current = os.path.basename(video.current_filename)
+                        path = current + ".part" if os.path.isfile(config.config.saveDir + "/" + channel + "/" + current + ".part") else current
                 break
+    # Split MPEG-TS files at their keyframes if they could be indexed, so
+    # seeking only needs one range request
+    if path.endswith(".ts") or path.endswith(".ts.part"):
+        full = config.config.saveDir + "/" + channel + "/" + path if path.endswith(".part") else config.config.resolve(channel + "/" + path)
+        index = await asyncio.to_thread(tsindex.update, full)
+        playlist = tsindex.playlist(index, path, not path.endswith(".part")) if index is not None else None
+        if playlist is not None: return playlist
     if path.endswith(".part"): return "#EXTM3U\n#EXT-X-TARGETDURATION:" + duration + "\n#EXT-X-VERSION:3\n#EXT-X-MEDIA-SEQUENCE:0\n#EXTINF:" + duration + "\n" + quote(path) + "\n"
     else: return "#EXTM3U\n#EXT-X-TARGETDURATION:" + duration + "\n#EXT-X-VERSION:3\n#EXT-X-MEDIA-SEQUENCE:0\n#EXT-X-PLAYLIST-TYPE:VOD\n#EXTINF:" + duration + "\n" + quote(path) + "\n#EXT-X-ENDLIST\n"
 
+@app.route("/previews/blobs/<hash>.jpg")
+async def preview_blob(hash: str):
+    # Blobs are named by their contents, so they never change
+    if all(c in "0123456789abcdef" for c in hash) and os.path.isfile(previews.blob_path(hash)):
+        return await send_file(previews.blob_path(hash), cache_timeout=31536000, mimetype="image/jpeg")
+    else: return (await render_template("404.html", message="The requested file does not exist."), 404)
+
+@app.route("/previews/<channel>/<int:timestamp>/poster.jpg")
+async def preview_poster(channel, timestamp):
+    for info in channels.recordings:
+        if info.channel == channel and info.timestamp == timestamp:
+            manifest = previews.get_manifest(previews.get_key(info.platform, info.channel, info.timestamp))
+            if manifest is None or manifest["poster"] is None: break
+            res = redirect("/previews/blobs/" + manifest["poster"] + ".jpg")
+            res.cache_control.max_age = 300
+            return res
+    return (await render_template("404.html", message="The requested preview does not exist."), 404)
+
+@app.route("/previews/<channel>/<int:timestamp>/thumbnails.vtt")
+async def preview_vtt(channel, timestamp):
+    for info in channels.recordings:
+        if info.channel == channel and info.timestamp == timestamp:
+            vtt = previews.get_vtt(previews.get_key(info.platform, info.channel, info.timestamp))
+            if vtt is None: break
+            return (vtt, 200, {"Content-Type": "text/vtt", "Cache-Control": "no-cache" if info.in_progress else "max-age=3600"})
+    return (await render_template("404.html", message="The requested preview does not exist."), 404)
+
 @app.route("/settings")
 async def settings():
     return await render_template("settings.html", settings=config.config._dump(True))
@@ -160,6 +230,29 @@ async def api_settings():
             if "time" in data["globalRetention"] and data["globalRetention"]["time"] is not None and type(data["globalRetention"]["time"]) != int: return ({"error": "'globalRetention.time' not an integer"}, 400)
             if "size" in data["globalRetention"] and data["globalRetention"]["size"] is not None and type(data["globalRetention"]["size"]) != int: return ({"error": "'globalRetention.size' not an integer"}, 400)
             config.config.globalRetention = config.Retention(data["globalRetention"])
+        # Cluster settings are saved, but only take effect on restart
+        if "clusterStore" in data:
+            if type(data["clusterStore"]) != str and data["clusterStore"] is not None: return ({"error": "'clusterStore' not a string"}, 400)
+            config.config.clusterStore = data["clusterStore"]
+        if "nodeName" in data:
+            if type(data["nodeName"]) != str and data["nodeName"] is not None: return ({"error": "'nodeName' not a string"}, 400)
+            config.config.nodeName = data["nodeName"]
+        if "clipCacheSize" in data:
+            if type(data["clipCacheSize"]) != int or data["clipCacheSize"] <= 0: return ({"error": "'clipCacheSize' not a positive integer"}, 400)
+            config.config.clipCacheSize = data["clipCacheSize"]
+        if "rateLimits" in data:
+            if type(data["rateLimits"]) != dict: return ({"error": "'rateLimits' not an object"}, 400)
+            for k, v in data["rateLimits"].items():
+                if type(v) != dict: return ({"error": f"'rateLimits.{k}' not an object"}, 400)
+                if "rate" in v and (type(v["rate"]) not in (int, float) or v["rate"] <= 0): return ({"error": f"'rateLimits.{k}.rate' not a positive number"}, 400)
+                if "burst" in v and (type(v["burst"]) != int or v["burst"] < 1): return ({"error": f"'rateLimits.{k}.burst' not a positive integer"}, 400)
+            config.config.rateLimits = {k: config.RateLimit(v) for k, v in data["rateLimits"].items()}
+        if "coldStorage" in data:
+            if type(data["coldStorage"]) != dict: return ({"error": "'coldStorage' not an object"}, 400)
+            if "path" in data["coldStorage"] and data["coldStorage"]["path"] is not None and type(data["coldStorage"]["path"]) != str: return ({"error": "'coldStorage.path' not a string"}, 400)
+            for k in ("time", "size", "rate"):
+                if k in data["coldStorage"] and data["coldStorage"][k] is not None and (type(data["coldStorage"][k]) != int or data["coldStorage"][k] <= 0): return ({"error": f"'coldStorage.{k}' not a positive integer"}, 400)
+            config.config.coldStorage = config.Tiering(data["coldStorage"])
         config.config.save(os.getenv("YTDVR_CONFIG") or "ytdvr_config.json")
         return (config.config._dump(True), 200)
     else: return ({"error": "Invalid request method"}, 405)
@@ -262,6 +355,54 @@ async def api_video(channel, timestamp):
         return ({"error": "Video not found"}, 404)
     else: return ({"error": "Invalid request method"}, 405)
 
+@app.route("/api/cluster")
+async def api_cluster():
+    return await asyncio.to_thread(cluster.coordinator._dump)
+
+@app.route("/api/ratelimits")
+async def api_ratelimits():
+    return ratelimit._dump()
+
+@app.route("/api/reconcile", methods=["GET", "POST"])
+async def api_reconcile():
+    if request.method == "GET":
+        return reconcile.status
+    elif request.method == "POST":
+        if reconcile.status["running"]: return ({"error": "Reconciliation already running"}, 409)
+        asyncio.create_task(reconcile.reconcile())
+        return (reconcile.status, 202)
+    else: return ({"error": "Invalid request method"}, 405)
+
+@app.route("/api/profile")
+async def api_profile():
+    try: seconds = float(request.args["seconds"]) if "seconds" in request.args else 10
+    except ValueError: return ({"error": "'seconds' not a number"}, 400)
+    if seconds <= 0 or seconds > profiling.MAX_PROFILE_LENGTH: return ({"error": f"'seconds' must be between 0 and {profiling.MAX_PROFILE_LENGTH}"}, 400)
+    if profiling.running(): return ({"error": "A profile is already being taken"}, 409)
+    try: profile = await asyncio.to_thread(profiling.sample, seconds)
+    except RuntimeError: return ({"error": "A profile is already being taken"}, 409)
+    return Response(profile, mimetype="text/plain")
+
+@app.route("/api/channels/<channel>/<int:timestamp>/clip")
+async def api_video_clip(channel, timestamp):
+    try:
+        start = float(request.args["start"])
+        end = float(request.args["end"])
+    except (KeyError, ValueError): return ({"error": "'start' and 'end' not numbers"}, 400)
+    if not math.isfinite(start) or not math.isfinite(end) or start < 0 or end <= start: return ({"error": "Invalid clip range"}, 400)
+    if end - start > clips.MAX_CLIP_LENGTH: return ({"error": f"Clips can be at most {clips.MAX_CLIP_LENGTH} seconds long"}, 400)
+    for info in channels.recordings:
+        if info.channel == channel and info.timestamp == timestamp:
+            try: path = await clips.get_clip(info, start, end)
+            except FileNotFoundError: return ({"error": "Video file not found"}, 404)
+            except Exception as e:
+                LOG.error(f"Could not cut clip from {info.filename}: {e}")
+                return ({"error": "Could not cut clip"}, 500)
+            ext = os.path.splitext(path)[1]
+            name = os.path.basename(info.filename).removesuffix(ext) + f" ({start:g}-{end:g})" + ext
+            return await send_file(path, cache_timeout=86400, mimetype="video/mpeg-ts" if ext == ".ts" else None, conditional=True, as_attachment=True, attachment_filename=name)
+    return ({"error": "Video not found"}, 404)
+
 @app.route("/api/videos")
 async def api_videos():
     retval = [info._dump() for info in channels.recordings]
@@ -1,20 +1,38 @@
+from collections import OrderedDict
 from copy import copy
-from typing import Optional, cast, Callable, Any
-from yt_dlp import YoutubeDL, utils
+from typing import Optional, cast, Callable, Any, TYPE_CHECKING
 import asyncio
 import ctypes
 import datetime
-import ffmpeg
+import gzip
 import importlib
+import json
 import logging
 import os
-import pathvalidate
+import signal
 import sys
 import threading
+import time
 sys.path.append("..")
 from config import config, LOG, Retention
+import clips
+import previews
+import ratelimit
+import tsindex
+# yt-dlp, ffmpeg and pathvalidate are slow to import, so they're only loaded
+# once they're actually needed, keeping server startup fast
+if TYPE_CHECKING: from yt_dlp import YoutubeDL
 
 LOG = logging.getLogger("yt-dvr")
+SESSION_POOL_SIZE = 32
+# Chat logs are written out after this many seconds or lines, whichever comes first
+CHAT_FLUSH_INTERVAL = 5
+CHAT_FLUSH_LINES = 200
+# Seconds without any data before a recording is considered stalled and restarted
+STALL_TIMEOUT = 15
+# Returned by check_live when the platform is throttling requests, so the
+# channel's status is unknown rather than offline
+THROTTLED = "throttled"
 
 def ctype_async_raise(target_tid, exception):
     ret = ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_long(target_tid), ctypes.py_object(exception))
@@ -28,6 +46,29 @@ def ctype_async_raise(target_tid, exception):
         ctypes.pythonapi.PyThreadState_SetAsyncExc(target_tid, ctypes.c_void_p(0))
         raise SystemError("PyThreadState_SetAsyncExc failed")
 
+def _child_processes(output: str) -> list[int]:
+    """
+    Returns the PIDs of this process's children whose last argument (their
+    output file, for ffmpeg) ends with a path. This only works on Linux, and
+    returns nothing elsewhere.
+
+    :param output: The end of the output path to look for
+    """
+    pids = []
+    try: entries = os.listdir("/proc")
+    except OSError: return pids
+    me = os.getpid()
+    for entry in entries:
+        if not entry.isdigit(): continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as file: stat = file.read()
+            # The command name may contain spaces, so fields are counted from after it
+            if int(stat[stat.rindex(")") + 2:].split(" ")[1]) != me: continue
+            with open(f"/proc/{entry}/cmdline", "rb") as file: args = file.read().rstrip(b"\0").split(b"\0")
+        except (OSError, ValueError, IndexError): continue
+        if os.fsdecode(args[-1]).endswith(output): pids.append(int(entry))
+    return pids
+
 class ChatRecorder:
     """
     An abstract class representing a chat recorder for a platform.
@@ -39,6 +80,74 @@ class ChatRecorder:
         """
         raise NotImplementedError()
 
+class ChatSink:
+    """
+    A gzip-compressed chat log. Lines are buffered and written out every few
+    seconds or every `CHAT_FLUSH_LINES` lines, so busy chats don't cause a
+    write for every message. Each write ends with a sync flush, so everything
+    written so far can be read while the recording is ongoing.
+
+    This may be used from any thread.
+    """
+    _file: gzip.GzipFile
+    _lines: list[str]
+    _timer: Optional[threading.Timer]
+    _lock: threading.Lock
+    _closed: bool
+
+    def __init__(self, filename: str):
+        """
+        Opens a chat log for writing.
+
+        :param filename: The file path to save at, which should end in `.gz`
+        """
+        self._file = gzip.open(filename, "wb") # type: ignore
+        self._lines = []
+        self._timer = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def write(self, line: str):
+        """
+        Adds a line to the log. Lines written after the log is closed are dropped.
+
+        :param line: The text to write, including its newline
+        """
+        with self._lock:
+            if self._closed: return
+            self._lines.append(line)
+            if len(self._lines) >= CHAT_FLUSH_LINES: self._flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(CHAT_FLUSH_INTERVAL, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if len(self._lines) == 0: return
+        self._file.write("".join(self._lines).encode("utf8"))
+        self._file.flush()
+        self._lines = []
+
+    def flush(self):
+        """
+        Writes out any buffered lines.
+        """
+        with self._lock:
+            if not self._closed: self._flush()
+
+    def close(self):
+        """
+        Writes out any buffered lines and closes the log.
+        """
+        with self._lock:
+            if self._closed: return
+            self._flush()
+            self._closed = True
+            self._file.close()
+
 def get_chat_recorder(loop: asyncio.EventLoop, platform: str, url: str, filename: str, info: Optional[dict]) -> Optional[ChatRecorder]:
     """
     Returns a chat recorder for a platform, if available, and starts recording.
@@ -59,28 +168,28 @@ def get_chat_recorder(loop: asyncio.EventLoop, platform: str, url: str, filename
         return kick.KickChatRecorder(loop, url, filename)
     return None
 
-class RecordingInfo:
+class Recording:
     """
-    Information about a live stream. This is derived by platforms to implement
-    a recording session.
+    A recording stored on disk. Finished recordings are kept in this compact
+    form, since there may be a very large number of them; active recording
+    sessions use the `RecordingInfo` subclass.
     """
+    __slots__ = ("platform", "channel", "title", "timestamp", "url", "_name", "_chat_name")
     platform: str
     channel: str
     title: str
     timestamp: int
     url: str
-    filename: str
-    chat_filename: Optional[str]
-    in_progress: bool
+    in_progress = False
+    # The part being written, if the download was restarted (see `RecordingInfo`)
+    part = 0
 
-    _ytdlProcess: Optional[threading.Thread]
-    _chatRecorder: Optional[ChatRecorder]
-    _stop: bool
-    _abort: bool
+    _name: str
+    _chat_name: Optional[str]
 
-    def __init__(self, platform: str, channel: str, title: str, timestamp: int, url: str, filename: str, chat_filename: Optional[str], in_progress: bool):
+    def __init__(self, platform: str, channel: str, title: str, timestamp: int, url: str, filename: str, chat_filename: Optional[str]):
         """
-        Creates a base recording object.
+        Creates a recording object.
 
         :param platform: The ID of the platform that started the recording
         :param channel: The ID of the channel that is being recorded
@@ -88,55 +197,45 @@ class RecordingInfo:
         :param timestamp: The time the recording started
         :param url: The original URL of the video
         :param filename: The path of the file on disk, relative to saveDir
-        :param in_progress: Whether the recording is ongoing
+        :param chat_filename: The path of the chat log on disk, relative to saveDir
         """
-        self.platform = platform
-        self.channel = channel
+        # Platform and channel names are shared by many recordings
+        self.platform = sys.intern(platform)
+        self.channel = sys.intern(channel)
         self.title = title
         self.timestamp = timestamp
         self.url = url
         self.filename = filename
         self.chat_filename = chat_filename
-        self.in_progress = in_progress
-        self._ytdlProcess = None
-        self._chatRecorder = None
-        self._stop = False
-        self._abort = False
 
-    @classmethod
-    def _create_ytdl(cls, loop: asyncio.EventLoop, dl: YoutubeDL, info: dict, getChat: bool, platform: str, channel: str, title: str):
-        """
-        Internal - Creates a recording for a yt-dl session.
+    # Paths are stored relative to the channel directory, and only expanded
+    # when they're needed
+    @property
+    def filename(self) -> str:
+        return self.channel + "/" + self._name
+
+    @filename.setter
+    def filename(self, value: str):
+        self._name = value.removeprefix(self.channel + "/")
+
+    # Chat logs normally share the video's name, so only their extension is
+    # stored in that case
+    @property
+    def chat_filename(self) -> Optional[str]:
+        if self._chat_name is None: return None
+        elif self._chat_name.startswith("."): return self.channel + "/" + self._name[:self._name.rfind(".")] + self._chat_name
+        else: return self.channel + "/" + self._chat_name
+
+    @chat_filename.setter
+    def chat_filename(self, value: Optional[str]):
+        if value is None:
+            self._chat_name = None
+            return
+        value = value.removeprefix(self.channel + "/")
+        stem = self._name[:self._name.rfind(".")]
+        if value.startswith(stem + "."): self._chat_name = sys.intern(value.removeprefix(stem))
+        else: self._chat_name = value
 
-        :param loop: The event loop for the main thread
-        :param dl: The yt-dl session that was initialized
-        :param info: The info about the video
-        :param getChat: Whether to create a chat recorder with the recording
-        :param platform: The ID of the platform that started the recording
-        :param channel: The ID of the channel that is being recorded
-        :param title: The title of the video
-        """
-        self = RecordingInfo(
-            platform, channel, title,
-            int(datetime.datetime.now().timestamp()),
-            cast(str, info["original_url"]),
-            channel + "/" + pathvalidate.sanitize_filename(datetime.datetime.now().isoformat(sep=" ", timespec="seconds").replace(":", "-") + " - " + title + ".ts"),
-            channel + "/" + pathvalidate.sanitize_filename(datetime.datetime.now().isoformat(sep=" ", timespec="seconds").replace(":", "-") + " - " + title + ".txt") if getChat is not None else None,
-            True)
-        try: os.makedirs(config.saveDir + "/" + channel)
-        except FileExistsError: pass
-        dl.params["outtmpl"] = {"default": config.saveDir + "/" + self.filename} # TODO: proper path and extension
-        dl.params["hls_use_mpegts"] = True
-        #dl.params["writesubtitles"] = True
-        #dl.params["subtitleslangs"] = ["live_chat"]
-        dl.params["wait_for_video"] = (2, 5)
-        self._ytdlProcess = threading.Thread(target=self._ytdlMain, name=self.filename, args=[dl, loop]) # type: ignore
-        self._ytdlProcess.start()
-        if getChat: self._chatRecorder = get_chat_recorder(loop, platform, cast(str, info["original_url"]), config.saveDir + "/" + cast(str, self.chat_filename), info)
-        loop.call_soon_threadsafe(self._insert_into_db)
-        LOG.info(f"Starting recording process (TID {self._ytdlProcess.native_id})")
-        return self
-    
     def _insert_into_db(self):
         cur = config.db.cursor()
         cur.execute("INSERT INTO videos VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
@@ -147,28 +246,21 @@ class RecordingInfo:
         """
         Stops a pending recording if in progress, triggering a remux if necessary.
         """
-        if self._ytdlProcess is not None:
-            self._stop = True
-            ctype_async_raise(self._ytdlProcess.ident, KeyboardInterrupt)
-            self._ytdlProcess.join()
-        if self._chatRecorder is not None: self._chatRecorder.stop()
-    
+        pass
+
     def abort(self):
         """
         Aborts a pending recording if in progress, skipping remux. This is used
         on server close.
         """
-        if self._ytdlProcess is not None:
-            self._abort = True
-            self._stop = True
-            ctype_async_raise(self._ytdlProcess.ident, KeyboardInterrupt)
-        if self._chatRecorder is not None: self._chatRecorder.stop()
+        pass
 
     def remux(self):
         """
         Remuxes the recording if necessary.
         """
         if self.filename.endswith("." + config.remuxFormat): return
+        import ffmpeg
         LOG.info("Remuxing container for " + self.title + " (" + self.filename + ")")
         newname = self.filename.removesuffix(".ts") + "." + config.remuxFormat
         try:
@@ -179,10 +271,76 @@ class RecordingInfo:
                 .output(filename=config.saveDir + "/" + newname, f=config.remuxFormat, codec="copy", extra_options={"movflags": "+faststart", "y": True, "loglevel": config.logLevel.lower(), "hide_banner": True})).run()
             try: os.remove(input)
             except: pass
+            tsindex.remove(input)
+            clips.forget(self.filename)
             self.filename = newname
         except Exception as e:
             LOG.error(e)
     
+    def _part_filename(self, n: int) -> str:
+        """
+        Internal - Returns the path of a later part of the recording, written
+        after the download was restarted.
+        """
+        stem, ext = os.path.splitext(self.filename)
+        return f"{stem}.{n}{ext}"
+
+    @property
+    def current_filename(self) -> str:
+        """
+        The path of the file being written, relative to saveDir. This is the
+        latest part if the download was restarted, and `filename` otherwise.
+        """
+        return self.filename if self.part == 0 else self._part_filename(self.part)
+
+    def _parts(self) -> list[str]:
+        """
+        Internal - Returns the paths of the parts of the recording that exist
+        in saveDir, starting with the first.
+        """
+        paths = []
+        n = 0
+        while True:
+            path = config.saveDir + "/" + (self.filename if n == 0 else self._part_filename(n))
+            if not os.path.exists(path): path += ".part"
+            if os.path.exists(path): paths.append(path)
+            elif n > 0: break
+            n += 1
+        return paths
+
+    def stitch(self):
+        """
+        Joins the parts of a recording that was restarted partway through into
+        a single file. This blocks, so it must not be called from the main
+        thread.
+        """
+        if not self.filename.endswith(".ts"): return
+        output = config.saveDir + "/" + self.filename
+        inputs = self._parts()
+        if len(inputs) == 0 or (len(inputs) == 1 and inputs[0].removesuffix(".part") == output): return
+        import ffmpeg
+        LOG.info(f"Joining {len(inputs)} parts of " + self.title + " (" + self.filename + ")")
+        listfile = output + ".concat"
+        try:
+            with open(listfile, "w") as file:
+                for path in inputs: file.write("file '" + os.path.abspath(path).replace("'", "'\\''") + "'\n")
+            (ffmpeg
+                .input(filename=listfile, extra_options={"f": "concat", "safe": 0})
+                .output(filename=output + ".tmp", f="mpegts", codec="copy", extra_options={"y": True, "loglevel": config.logLevel.lower(), "hide_banner": True})).run()
+            os.replace(output + ".tmp", output)
+            tsindex.remove(output)
+            clips.forget(self.filename)
+            for path in inputs:
+                tsindex.remove(path)
+                if path == output: continue
+                try: os.remove(path)
+                except OSError: pass
+        except Exception as e:
+            LOG.error(e)
+        finally:
+            try: os.remove(listfile)
+            except OSError: pass
+
     def update(self, platform: str | None = None, channel: str | None = None, timestamp: int | None = None):
         """
         Updates the recording status in the database, and remuxes if necessary.
@@ -214,10 +372,16 @@ class RecordingInfo:
         cur = config.db.cursor()
         cur.execute("DELETE FROM videos WHERE platform = ? AND channel = ? AND timestamp = ?", (self.platform, self.channel, self.timestamp))
         config.db.commit()
+        # Parts from a restarted recording that was never stitched would
+        # otherwise be adopted as recordings of their own
+        for path in [config.resolve(self.filename)] + self._parts():
+            tsindex.remove(path)
+            try: os.remove(path)
+            except OSError: pass
         try:
-            os.remove(config.saveDir + "/" + self.filename)
-            if self.chat_filename is not None: os.remove(config.saveDir + "/" + self.chat_filename)
+            if self.chat_filename is not None: os.remove(config.resolve(self.chat_filename))
         except: pass
+        previews.forget(self.platform, self.channel, self.timestamp)
 
     def _dump(self):
         return {
@@ -228,38 +392,288 @@ class RecordingInfo:
             "original_url": self.url,
             "path": "/files/" + self.filename,
             "chat_path": "/files/" + self.chat_filename if self.chat_filename is not None else None,
+            "poster_path": f"/previews/{self.channel}/{self.timestamp}/poster.jpg",
+            "thumbnails_path": f"/previews/{self.channel}/{self.timestamp}/thumbnails.vtt",
             "in_progress": self.in_progress
         }
 
-    def _ytdlProgress(self, _):
+class RecordingInfo(Recording):
+    """
+    Information about a live stream. This is derived by platforms to implement
+    a recording session.
+    """
+    in_progress: bool
+
+    _ytdlProcess: Optional[threading.Thread]
+    _chatRecorder: Optional[ChatRecorder]
+    _stop: bool
+    _abort: bool
+    _restart: bool
+    _downloading: bool
+
+    def __init__(self, platform: str, channel: str, title: str, timestamp: int, url: str, filename: str, chat_filename: Optional[str], in_progress: bool):
+        """
+        Creates a base recording object.
+
+        :param platform: The ID of the platform that started the recording
+        :param channel: The ID of the channel that is being recorded
+        :param title: The title of the video
+        :param timestamp: The time the recording started
+        :param url: The original URL of the video
+        :param filename: The path of the file on disk, relative to saveDir
+        :param chat_filename: The path of the chat log on disk, relative to saveDir
+        :param in_progress: Whether the recording is ongoing
+        """
+        super().__init__(platform, channel, title, timestamp, url, filename, chat_filename)
+        self.in_progress = in_progress
+        self._ytdlProcess = None
+        self._chatRecorder = None
+        self._stop = False
+        self._abort = False
+        self._restart = False
+        self._downloading = False
+
+    @classmethod
+    def _create_ytdl(cls, loop: asyncio.EventLoop, dl: "YoutubeDL", info: dict, getChat: bool, platform: str, channel: str, title: str):
+        """
+        Internal - Creates a recording for a yt-dl session.
+
+        :param loop: The event loop for the main thread
+        :param dl: The yt-dl session that was initialized
+        :param info: The info about the video
+        :param getChat: Whether to create a chat recorder with the recording
+        :param platform: The ID of the platform that started the recording
+        :param channel: The ID of the channel that is being recorded
+        :param title: The title of the video
+        """
+        import pathvalidate
+        self = RecordingInfo(
+            platform, channel, title,
+            int(datetime.datetime.now().timestamp()),
+            cast(str, info["original_url"]),
+            channel + "/" + pathvalidate.sanitize_filename(datetime.datetime.now().isoformat(sep=" ", timespec="seconds").replace(":", "-") + " - " + title + ".ts"),
+            channel + "/" + pathvalidate.sanitize_filename(datetime.datetime.now().isoformat(sep=" ", timespec="seconds").replace(":", "-") + " - " + title + ".txt.gz") if getChat is not None else None,
+            True)
+        try: os.makedirs(config.saveDir + "/" + channel)
+        except FileExistsError: pass
+        dl.params["hls_use_mpegts"] = True
+        # Live HLS is downloaded by ffmpeg, which otherwise waits forever on a
+        # stalled connection. yt-dlp's own downloaders use socket_timeout.
+        downloaderArgs = dl.params.get("external_downloader_args")
+        if downloaderArgs is None or type(downloaderArgs) == dict:
+            downloaderArgs = dict(downloaderArgs or {})
+            downloaderArgs.setdefault("ffmpeg_i", ["-rw_timeout", str(STALL_TIMEOUT * 1000000)])
+            dl.params["external_downloader_args"] = downloaderArgs
+        dl.params.setdefault("socket_timeout", STALL_TIMEOUT)
+        #dl.params["writesubtitles"] = True
+        #dl.params["subtitleslangs"] = ["live_chat"]
+        dl.params["wait_for_video"] = (2, 5)
+        self._ytdlProcess = threading.Thread(target=self._ytdlMain, name=self.filename, args=[dl, loop]) # type: ignore
+        self._ytdlProcess.start()
+        if getChat: self._chatRecorder = get_chat_recorder(loop, platform, cast(str, info["original_url"]), config.saveDir + "/" + cast(str, self.chat_filename), info)
+        loop.call_soon_threadsafe(self._insert_into_db)
+        LOG.info(f"Starting recording process (TID {self._ytdlProcess.native_id})")
+        return self
+    
+    def stop(self):
+        """
+        Stops a pending recording if in progress, triggering a remux if necessary.
+        """
+        if self._ytdlProcess is not None:
+            self._stop = True
+            self._restart = False
+            self._interrupt(cast(int, self._ytdlProcess.ident))
+            self._ytdlProcess.join()
+        if self._chatRecorder is not None: self._chatRecorder.stop()
+    
+    def abort(self):
+        """
+        Aborts a pending recording if in progress, skipping remux. This is used
+        on server close.
+        """
+        if self._ytdlProcess is not None:
+            self._abort = True
+            self._stop = True
+            self._restart = False
+            self._interrupt(cast(int, self._ytdlProcess.ident))
+        if self._chatRecorder is not None: self._chatRecorder.stop()
+
+    def _interrupt(self, tid: int):
+        ctype_async_raise(tid, KeyboardInterrupt)
+        # ffmpeg is waited on in C, where the exception isn't raised until it
+        # exits. It finishes the file properly on SIGTERM.
+        for pid in _child_processes(self.current_filename + ".part") + _child_processes(self.current_filename):
+            try: os.kill(pid, signal.SIGTERM)
+            except OSError: pass
+
+    def _size(self) -> int:
+        # The size of the current part on disk, which is the only progress
+        # ffmpeg reports while it's running
+        path = config.saveDir + "/" + self.current_filename
+        for p in (path + ".part", path):
+            try: return os.path.getsize(p)
+            except OSError: pass
+        return 0
+
+    def _ytdlProgress(self, d: dict):
         if self._stop:
             self._stop = False
             raise KeyboardInterrupt()
 
-    def _ytdlMain(self, dl: YoutubeDL, loop: asyncio.EventLoop):
+    def _watchdog(self, tid: int, done: threading.Event):
+        # Only armed once data has started arriving, so waiting for a stream
+        # to start isn't mistaken for a stall
+        size = 0
+        last = time.monotonic()
+        while not done.wait(1):
+            current = self._size() if self._downloading else 0
+            if current != size:
+                size = current
+                last = time.monotonic()
+            if size == 0 or time.monotonic() - last < STALL_TIMEOUT: continue
+            LOG.warning(f"Recording of {self.title} stalled for {STALL_TIMEOUT}s, restarting")
+            self._restart = True
+            last = time.monotonic()
+            try: self._interrupt(tid)
+            except (ValueError, SystemError): return
+
+    def _ytdlMain(self, dl: "YoutubeDL", loop: asyncio.EventLoop):
         dl.add_progress_hook(self._ytdlProgress)
-        try: dl.download(self.url)
-        except: LOG.error("A download error occurred in " + self.title)
+        done = threading.Event()
+        threading.Thread(target=self._watchdog, name=self.filename + " (watchdog)", args=[threading.get_ident(), done], daemon=True).start()
+        part = 0
+        try:
+            # Stalled or failed downloads are restarted right away into a new
+            # part, until the stream ends or a restart gets no data
+            while True:
+                self.part = part
+                dl.params["outtmpl"] = {"default": config.saveDir + "/" + self.current_filename}
+                self._restart = False
+                self._downloading = True
+                try: dl.download(self.url)
+                except KeyboardInterrupt:
+                    if not self._restart: break
+                except: LOG.error("A download error occurred in " + self.title)
+                else:
+                    if not self._restart: break
+                finally: self._downloading = False
+                if self._abort or self._size() == 0: break
+                part += 1
+                LOG.info(f"Restarting recording of {self.title} (part {part + 1})")
+        except KeyboardInterrupt: pass
         finally:
+            done.set()
+            # The recording only counts as finished once its parts are joined,
+            # so nothing reads the first part on its own as the whole file
+            if not self._abort and part > 0:
+                self.stitch()
+                self.part = 0
             self.in_progress = False
             if not self._abort:
-                if not self.in_progress and self.filename.endswith(".ts") and config.remuxRecordings:
+                if self.filename.endswith(".ts") and config.remuxRecordings:
                     self.remux()
                 loop.call_soon_threadsafe(self.update)
             self._ytdlProcess = None
 
+class SessionPool:
+    """
+    A pool of long-lived yt-dl sessions used for liveness checks. Sessions are
+    keyed by their parameters, and are reused between polls so that HTTP
+    connections, cookies and extractors aren't set up again every time. Idle
+    sessions are evicted in least-recently-used order once the pool is full.
+    """
+    size: int
+
+    _idle: OrderedDict[str, list["YoutubeDL"]]
+    _count: int
+    _lock: threading.Lock
+
+    def __init__(self, size: int):
+        """
+        Creates a new session pool.
+
+        :param size: The maximum number of idle sessions to keep
+        """
+        self.size = size
+        self._idle = OrderedDict()
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, params: dict) -> tuple[str, "YoutubeDL"]:
+        """
+        Takes a session out of the pool, creating a new one if none is idle.
+        Sessions must be returned with `release` after use.
+
+        :param params: The parameters for the session
+        :returns: The key to release the session with, and the session
+        """
+        key = json.dumps(params, sort_keys=True, default=str)
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self._count -= 1
+                return key, idle.pop()
+        from yt_dlp import YoutubeDL
+        return key, YoutubeDL(copy(params)) # type: ignore
+
+    def release(self, key: str, dl: "YoutubeDL"):
+        """
+        Returns a session to the pool.
+
+        :param key: The key returned by `acquire`
+        :param dl: The session to return
+        """
+        evicted = []
+        with self._lock:
+            self._idle.setdefault(key, []).append(dl)
+            self._idle.move_to_end(key)
+            self._count += 1
+            while self._count > self.size:
+                oldKey, idle = next(iter(self._idle.items()))
+                evicted.append(idle.pop(0))
+                self._count -= 1
+                if not idle: del self._idle[oldKey]
+        for old in evicted:
+            try: old.close()
+            except: pass
+
+sessions = SessionPool(SESSION_POOL_SIZE)
+
 class Channel:
     """
     Contains information about a channel to monitor.
     """
-    url: str
+    __slots__ = ("_url", "getChat", "platform", "ytdlParams", "retention", "quality", "_extractor")
     getChat: bool
     platform: Optional[str]
     ytdlParams: Optional[dict]
     retention: Optional[Retention]
     quality: Optional[str]
 
+    _url: str
+    _extractor: Optional[str]
+
     def __init__(self, obj: dict):
+        self._load(obj)
+
+    # The platform is detected from the URL, so it's looked up again when the
+    # URL changes
+    @property
+    def url(self) -> str:
+        return self._url
+
+    @url.setter
+    def url(self, value: str):
+        self._url = value
+        self._extractor = None
+
+    def _load(self, obj: dict):
+        """
+        Internal - Loads the channel options from a config object. This is also
+        used to update a channel in place when the config is reloaded.
+
+        :param obj: The channel object from the config
+        """
         self.url = obj["url"]
         self.getChat = obj["getChat"]
         if "platform" in obj: self.platform = obj["platform"]
@@ -270,22 +684,58 @@ class Channel:
         else: self.retention = None
         if "quality" in obj: self.quality = obj["quality"]
         else: self.quality = None
+        self._extractor = None
 
-    def _check_live(self, loop: asyncio.EventLoop, future: asyncio.Future):
-        dl = YoutubeDL(copy(self.ytdlParams)) # type: ignore
-        if not ("noprogress" in dl.params) and LOG.level > logging.DEBUG: dl.params["noprogress"] = True
-        if not ("quiet" in dl.params) and LOG.level > logging.DEBUG: dl.params["quiet"] = True
+    def _extractor_key(self) -> str:
+        """
+        Internal - Returns the yt-dlp extractor key for the channel's URL,
+        which identifies the platform for rate limiting.
+        """
+        if self.platform is not None: return self.platform
+        if self._extractor is None:
+            from yt_dlp.extractor import gen_extractor_classes
+            self._extractor = next((ie.ie_key() for ie in gen_extractor_classes() if ie.suitable(self.url)), "Generic")
+        return self._extractor
+
+    def _check_params(self) -> dict:
+        params = copy(self.ytdlParams) if self.ytdlParams is not None else {}
+        if not ("noprogress" in params) and LOG.level > logging.DEBUG: params["noprogress"] = True
+        if not ("quiet" in params) and LOG.level > logging.DEBUG: params["quiet"] = True
+        return params
+
+    def _check(self) -> tuple[bool, Any]:
+        from yt_dlp import utils
+        platform = self._extractor_key()
+        if not ratelimit.acquire(platform): return False, THROTTLED
+        params = self._check_params()
+        key, dl = sessions.acquire(params)
         try:
             info = dl.extract_info(self.url, False)
-        except utils.DownloadError:
-            loop.call_soon_threadsafe(future.set_result, (False, None))
+        except utils.DownloadError as e:
+            throttled, retry_after = ratelimit.check_throttled(e)
+            if throttled:
+                ratelimit.throttled(platform, retry_after)
+                return False, THROTTLED
+            ratelimit.record(platform, "offline")
+            return False, None
+        finally: sessions.release(key, dl)
+        ratelimit.record(platform, "live")
+        return True, (params, info)
+
+    def _check_live(self, loop: asyncio.EventLoop, future: asyncio.Future):
+        # Anything that goes wrong has to reach the future, or check_live
+        # would wait forever
+        try: res = self._check()
+        except BaseException as e:
+            loop.call_soon_threadsafe(future.set_exception, e)
             return
-        loop.call_soon_threadsafe(future.set_result, (True, (dl, info))) # type: ignore
+        loop.call_soon_threadsafe(future.set_result, res)
 
     async def check_live(self) -> tuple[bool, Any]:
         """
         Checks if the channel is live, and if so, returns some internal metadata
-        to pass to download.
+        to pass to download. If the platform is throttling requests, the
+        channel is reported as not live with `THROTTLED` as the value.
 
         :returns: Whether the channel is live, and if so, an opaque value to pass to `download`
         """
@@ -297,10 +747,16 @@ class Channel:
         thread.join()
         return res
     
-    def _download(self, name: str, arg: tuple[YoutubeDL, dict], loop: asyncio.EventLoop, future: asyncio.Future):
-        dl, info = arg
-        dl.params["format"] = self.quality or "bestvideo+bestaudio"
+    def _download(self, name: str, arg: tuple[dict, dict], loop: asyncio.EventLoop, future: asyncio.Future):
         try:
+            from yt_dlp import YoutubeDL
+            params, info = arg
+            # A live stream was already found, so record it even while backing off
+            ratelimit.acquire(self._extractor_key())
+            ratelimit.record(self._extractor_key(), "download")
+            # Recordings get their own session, since pooled ones are shared
+            dl = YoutubeDL(copy(params)) # type: ignore
+            dl.params["format"] = self.quality or "bestvideo+bestaudio"
             loop.call_soon_threadsafe(future.set_result, RecordingInfo._create_ytdl(loop, dl, info, self.getChat, self.platform or info["extractor_key"], name, info["description"] if info["title"].find("(live)") != -1 else info["title"])) # type: ignore
         except BaseException as e:
             loop.call_soon_threadsafe(future.set_exception, e)
@@ -333,4 +789,4 @@ class Channel:
             "ytdlParams": self.ytdlParams
         }
 
-recordings: list[RecordingInfo] = []
+recordings: list[Recording] = []
@@ -1,6 +1,5 @@
-from . import ChatRecorder
+from . import ChatRecorder, ChatSink
 from dateutil import parser as dateparser
-from io import TextIOWrapper
 import asyncio
 import datetime
 import kickpython
@@ -13,7 +12,7 @@ class KickChatRecorder(ChatRecorder):
     running: bool
     conn: kickpython.KickAPI
     task: asyncio.Task
-    file: TextIOWrapper
+    file: ChatSink
     start_time: datetime.datetime
 
     def __init__(self, loop: asyncio.EventLoop, url: str, filename: str):
@@ -21,7 +20,7 @@ class KickChatRecorder(ChatRecorder):
         assert m
         name = m.group(2)
         self.running = True
-        self.file = open(filename, "w")
+        self.file = ChatSink(filename)
         self.conn = kickpython.KickAPI(db_path=os.getenv("YTDVR_DB") or "./ytdvr.db")
         self.conn.add_message_handler(self.onmessage)
         loop.create_task(self.conn.connect_to_chatroom(name))
@@ -30,7 +29,6 @@ class KickChatRecorder(ChatRecorder):
     async def onmessage(self, message: dict):
         d = dateparser.parse(message["created_at"])
         self.file.write("[%s][%d] %s: %s\n" % (d.isoformat(sep=" ", timespec="seconds"), (d - self.start_time).total_seconds(), message["sender_username"], message["content"]))
-        self.file.flush()
 
     async def _stop(self):
         await self.conn.close()
@@ -38,4 +36,4 @@ class KickChatRecorder(ChatRecorder):
 
     def stop(self):
         self.running = False
-        asyncio.create_task(self.conn.close())
+        asyncio.create_task(self._stop())
@@ -1,6 +1,5 @@
-from . import ChatRecorder
+from . import ChatRecorder, ChatSink
 from config import LOG
-from io import TextIOWrapper
 import datetime
 import random
 import re
@@ -13,7 +12,7 @@ chat_message_regex = re.compile(":(.+?)!.+?PRIVMSG #[\\w_]+ :(.+)")
 class TwitchChatRecorder(ChatRecorder):
     thread: threading.Thread
     conn: socket.socket
-    file: TextIOWrapper
+    file: ChatSink
     running: bool
     start_time: datetime.datetime
 
@@ -22,7 +21,7 @@ class TwitchChatRecorder(ChatRecorder):
         assert m
         name = m.group(2)
         self.running = True
-        self.file = open(filename, "w")
+        self.file = ChatSink(filename)
         self.conn = socket.socket(socket.AddressFamily.AF_INET, socket.SocketKind.SOCK_STREAM)
         self.thread = threading.Thread(target=self._worker, name="Twitch chat for " + name, args=[name])
         self.thread.start()
@@ -39,20 +38,15 @@ class TwitchChatRecorder(ChatRecorder):
                 m = chat_message_regex.match(line)
                 if m:
                     self.file.write("[%s][%d] %s: %s\n" % (datetime.datetime.now().isoformat(sep=" ", timespec="seconds"), (datetime.datetime.now() - self.start_time).total_seconds(), m.group(1), m.group(2)))
-                    self.file.flush()
                 elif "USERNOTICE" in line:
                     self.file.write("[%s][%d] %s" % (datetime.datetime.now().isoformat(sep=" ", timespec="seconds"), (datetime.datetime.now() - self.start_time).total_seconds(), line[line.find(" :") + 2:]))
-                    self.file.flush()
                 elif "CLEARMSG" in line:
                     self.file.write("[%s][%d] <message deleted>: %s" % (datetime.datetime.now().isoformat(sep=" ", timespec="seconds"), (datetime.datetime.now() - self.start_time).total_seconds(), line[line.find(" :") + 2:]))
-                    self.file.flush()
                 elif "CLEARCHAT" in line:
                     if " :" in line:
                         self.file.write("[%s][%d] Purged user %s" % (datetime.datetime.now().isoformat(sep=" ", timespec="seconds"), (datetime.datetime.now() - self.start_time).total_seconds(), line[line.find(" :") + 2:]))
-                        self.file.flush()
                     else:
                         self.file.write("[%s][%d] Purged chat\n" % (datetime.datetime.now().isoformat(sep=" ", timespec="seconds"), (datetime.datetime.now() - self.start_time).total_seconds()))
-                        self.file.flush()
                 if line.find("PING") != -1: self.conn.send(bytes(line.replace("PING", "PONG"), "utf8"))
         self.conn.close()
         self.file.close()
@@ -1,7 +1,6 @@
-from . import ChatRecorder
+from . import ChatRecorder, ChatSink
 from config import LOG
 from dateutil import parser as dateparser
-from io import TextIOWrapper
 from pytchat.processors.default.processor import Chatdata
 import asyncio
 import datetime
@@ -10,12 +9,12 @@ import pytchat
 class YoutubeChatRecorder(ChatRecorder):
     running: bool
     conn: pytchat.LiveChatAsync
-    file: TextIOWrapper
+    file: ChatSink
     start_time: datetime.datetime
 
     def __init__(self, loop: asyncio.EventLoop, info: dict, filename: str):
         self.running = True
-        self.file = open(filename, "w")
+        self.file = ChatSink(filename)
         asyncio.run_coroutine_threadsafe(self._start(info["id"]), loop)
         self.start_time = datetime.datetime.now()
 
@@ -29,7 +28,6 @@ class YoutubeChatRecorder(ChatRecorder):
         async for c in chatdata.async_items():
             d = dateparser.parse(c.datetime)
             self.file.write("[%s][%d] %s: %s\n" % (d.isoformat(sep=" ", timespec="seconds"), (d - self.start_time).total_seconds(), c.author.name, c.message))
-        self.file.flush()
 
     def stop(self):
         self.running = False
@@ -0,0 +1,146 @@
+from typing import TYPE_CHECKING
+from config import LOG, config
+import asyncio
+import datetime
+import hashlib
+import os
+import threading
+import time
+if TYPE_CHECKING: from channel import Recording
+
+# FFmpeg muxer names for file extensions that don't match them
+FORMATS = {".ts": "mpegts", ".mkv": "matroska", ".m4a": "mp4"}
+# The longest clip that can be cut, in seconds
+MAX_CLIP_LENGTH = 4 * 3600
+# Seconds a clip is kept from eviction after being returned, so it can't be
+# removed before it's opened to be sent
+SEND_GRACE = 60
+
+_pending: dict[str, asyncio.Future] = {}
+# Paths of clips that were returned, and when
+_sent: dict[str, float] = {}
+_lock = threading.Lock()
+
+def cache_dir() -> str:
+    return config.saveDir + "/.cache/clips"
+
+def _cut(input: str, output: str, start: float, end: float, format: str):
+    import ffmpeg
+    temp = output + ".tmp"
+    # Seeking on the input with stream copy starts the clip at the keyframe
+    # before `start`, so nothing has to be re-encoded
+    options = {"avoid_negative_ts": "make_zero", "y": True, "loglevel": config.logLevel.lower(), "hide_banner": True}
+    if format in ("mp4", "mov"): options["movflags"] = "+faststart"
+    (ffmpeg
+        .input(filename=input, extra_options={"ss": start, "t": end - start})
+        .output(filename=temp, f=format, codec="copy", extra_options=options)).run()
+    os.replace(temp, output)
+
+def _prefix(filename: str) -> str:
+    # Clips are named after the recording they came from, so they can be
+    # dropped when it's rewritten
+    return hashlib.sha1(filename.encode("utf8")).hexdigest()[:16] + "-"
+
+def forget(filename: str):
+    """
+    Removes the cached clips of a recording, when its file is rewritten. This
+    blocks, so it must not be called from the main thread.
+
+    :param filename: The path of the recording, relative to saveDir
+    """
+    prefix = _prefix(filename)
+    try:
+        with os.scandir(cache_dir()) as it:
+            for entry in it:
+                if entry.name.startswith(prefix):
+                    try: os.remove(entry.path)
+                    except OSError: pass
+    except FileNotFoundError: pass
+
+def _claim(path: str) -> bool:
+    # Keeps a cached clip from being evicted until it's been sent
+    with _lock:
+        if not os.path.exists(path): return False
+        _sent[path] = time.monotonic()
+        return True
+
+def _protected(path: str) -> bool:
+    # Must be called with _lock held
+    return path in _pending or (path in _sent and time.monotonic() - _sent[path] < SEND_GRACE)
+
+def _evict():
+    limit = config.clipCacheSize * 1000000
+    files = []
+    total = 0
+    with _lock:
+        for path in [p for p in _sent if not _protected(p)]: del _sent[path]
+    with os.scandir(cache_dir()) as it:
+        for entry in it:
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                # Clips being sent can't be removed, so they don't count
+                with _lock:
+                    if not _protected(entry.path): total += stat.st_size
+    # Clips too big for the cache go first, then the least recently used
+    files.sort(key=lambda f: (f[1] <= limit, f[0]))
+    for _, size, path in files:
+        if total <= limit: break
+        with _lock:
+            if _protected(path): continue
+            try: os.remove(path)
+            except OSError: pass
+        total -= size
+
+async def get_clip(recording: "Recording", start: float, end: float) -> str:
+    """
+    Returns the path to a clip of a recording, cutting it if it isn't cached.
+    Clips of finished ranges are cached on disk, and the cache is trimmed to
+    `clipCacheSize` in least-recently-used order.
+
+    This must be called from the main thread.
+
+    :param recording: The recording to cut from
+    :param start: The start of the clip, in seconds from the start of the recording
+    :param end: The end of the clip, in seconds from the start of the recording
+    :returns: The path to the clip file
+    """
+    input = config.resolve(recording.filename)
+    if not os.path.exists(input): input += ".part"
+    if not os.path.exists(input): raise FileNotFoundError(recording.filename)
+    ext = os.path.splitext(recording.filename)[1]
+    format = FORMATS.get(ext, ext[1:])
+    key = f"{recording.filename}\0{start}\0{end}"
+    # Clips past the end of an ongoing recording would be cut short, so they
+    # get a key that won't be reused once more has been recorded. After a
+    # restart, the first part no longer grows, so that goes for every clip.
+    complete = not recording.in_progress or (recording.part == 0 and end <= datetime.datetime.now().timestamp() - recording.timestamp)
+    if not complete: key += f"\0{os.path.getsize(input)}\0{recording.part}"
+    key = hashlib.sha1(key.encode("utf8")).hexdigest()
+    path = cache_dir() + "/" + _prefix(recording.filename) + key + ext
+    if _claim(path):
+        os.utime(path)
+        return path
+    if path in _pending: return await asyncio.shield(_pending[path])
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    with _lock: _pending[path] = future
+    try:
+        os.makedirs(cache_dir(), exist_ok=True)
+        LOG.info(f"Cutting clip {start}-{end} from {recording.filename}")
+        await asyncio.to_thread(_cut, input, path, start, end, format)
+        with _lock: _sent[path] = time.monotonic()
+        size = os.path.getsize(path)
+        future.set_result(path)
+    except Exception as e:
+        future.set_exception(e)
+        future.exception() # only raised to waiters
+        raise
+    finally:
+        with _lock: del _pending[path]
+    await asyncio.to_thread(_evict)
+    # A clip bigger than the whole cache is only sent, and removed once it
+    # no longer has to be kept for that
+    if size > config.clipCacheSize * 1000000:
+        loop.call_later(SEND_GRACE + 1, lambda: asyncio.ensure_future(asyncio.to_thread(_evict)))
+    return path
@@ -0,0 +1,169 @@
+from config import LOG, config
+import bisect
+import hashlib
+import socket
+import sqlite3
+import threading
+import time
+
+VIRTUAL_NODES = 64
+
+class Coordinator:
+    """
+    An abstract class representing a store shared between yt-dvr nodes, which
+    decides which node records each channel. Methods may block on the shared
+    store, so they must not be called from the main thread.
+    """
+
+    def heartbeat(self, channels: set[str]):
+        """
+        Marks this node as alive, and renews the leases this node holds on
+        channels. Leases on channels that are no longer configured are released.
+
+        :param channels: The names of the configured channels
+        """
+        raise NotImplementedError()
+
+    def acquire(self, channel: str) -> bool:
+        """
+        Attempts to take (or renew) the lease on a channel before checking it.
+
+        :param channel: The name of the channel
+        :returns: Whether this node owns the channel and should check it
+        """
+        raise NotImplementedError()
+
+    def leave(self):
+        """
+        Removes this node from the cluster, releasing all of its leases.
+        """
+        raise NotImplementedError()
+
+    def _dump(self) -> dict:
+        raise NotImplementedError()
+
+class LocalCoordinator(Coordinator):
+    """
+    A stand-in coordinator for a single node, which owns every channel.
+    """
+
+    def heartbeat(self, channels: set[str]): pass
+    def acquire(self, channel: str) -> bool: return True
+    def leave(self): pass
+
+    def _dump(self) -> dict:
+        return {"node": None, "nodes": [], "leases": {}}
+
+class SQLiteCoordinator(Coordinator):
+    """
+    A coordinator backed by a SQLite database on storage shared between nodes.
+    Channels are assigned to live nodes by consistent hashing, and a node only
+    records a channel while it holds an unexpired lease on it. Nodes and
+    leases time out after one poll interval, so a dead node's channels are
+    picked up by the others on their next poll. Live nodes renew their leases
+    with every heartbeat, several times per poll interval.
+    """
+    node: str
+    db: sqlite3.Connection
+
+    _lock: threading.Lock
+
+    _ring: tuple[frozenset[str], list[tuple[int, str]]]
+
+    def __init__(self, path: str, node: str):
+        """
+        Connects to a coordination store and joins the cluster.
+
+        :param path: The path to the shared SQLite database
+        :param node: The unique name of this node
+        """
+        self.node = node
+        # The connection is shared by the worker threads that call into the
+        # coordinator, one at a time
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.db.execute("CREATE TABLE IF NOT EXISTS nodes (node TEXT PRIMARY KEY, heartbeat REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS leases (channel TEXT PRIMARY KEY, node TEXT, expires REAL)")
+        self._ring = (frozenset(), [])
+        self.heartbeat(set())
+        LOG.info(f"Joined cluster at {path} as node {node}")
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.sha1(key.encode("utf8")).digest()[:8], "big")
+
+    def _nodes(self, now: float) -> frozenset[str]:
+        res = self.db.execute("SELECT node FROM nodes WHERE heartbeat > ?", (now - config.pollInterval,))
+        return frozenset(row[0] for row in res.fetchall()) | {self.node}
+
+    def _owner(self, channel: str, now: float) -> str:
+        nodes = self._nodes(now)
+        if self._ring[0] != nodes:
+            self._ring = (nodes, sorted((self._hash(f"{node}#{i}"), node) for node in nodes for i in range(VIRTUAL_NODES)))
+        ring = self._ring[1]
+        i = bisect.bisect(ring, (self._hash(channel), ""))
+        return ring[i % len(ring)][1]
+
+    def heartbeat(self, channels: set[str]):
+        with self._lock:
+            now = time.time()
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute("INSERT OR REPLACE INTO nodes VALUES (?, ?)", (self.node, now))
+                for channel, in self.db.execute("SELECT channel FROM leases WHERE node = ?", (self.node,)).fetchall():
+                    if channel in channels: self.db.execute("UPDATE leases SET expires = ? WHERE channel = ?", (now + config.pollInterval, channel))
+                    else: self.db.execute("DELETE FROM leases WHERE channel = ?", (channel,))
+                self.db.execute("COMMIT")
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def acquire(self, channel: str) -> bool:
+        with self._lock: return self._acquire(channel)
+
+    def _acquire(self, channel: str) -> bool:
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute("SELECT node, expires FROM leases WHERE channel = ?", (channel,)).fetchone()
+            if row is not None and row[0] != self.node and row[1] > now:
+                ok = False
+            elif self._owner(channel, now) != self.node:
+                # Hand the channel over to its new owner
+                if row is not None and row[0] == self.node:
+                    self.db.execute("DELETE FROM leases WHERE channel = ?", (channel,))
+                ok = False
+            else:
+                self.db.execute("INSERT OR REPLACE INTO leases VALUES (?, ?, ?)", (channel, self.node, now + config.pollInterval))
+                ok = True
+            self.db.execute("COMMIT")
+            return ok
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+
+    def leave(self):
+        with self._lock:
+            self.db.execute("DELETE FROM leases WHERE node = ?", (self.node,))
+            self.db.execute("DELETE FROM nodes WHERE node = ?", (self.node,))
+            self.db.close()
+        LOG.info(f"Left cluster as node {self.node}")
+
+    def _dump(self) -> dict:
+        with self._lock:
+            now = time.time()
+            return {
+                "node": self.node,
+                "nodes": sorted(self._nodes(now)),
+                "leases": {channel: node for channel, node in self.db.execute("SELECT channel, node FROM leases WHERE expires > ?", (now,)).fetchall()}
+            }
+
+def get_coordinator() -> Coordinator:
+    """
+    Returns the coordinator for the current config: a shared SQLite store if
+    `clusterStore` is set, or a local stand-in otherwise.
+    """
+    if config.clusterStore is None: return LocalCoordinator()
+    return SQLiteCoordinator(config.clusterStore, config.nodeName or socket.gethostname())
+
+coordinator: Coordinator = LocalCoordinator()
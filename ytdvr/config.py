@@ -2,6 +2,7 @@ from typing import Optional, cast, TYPE_CHECKING
 import importlib
 import json
 import logging
+import os
 import sqlite3
 if TYPE_CHECKING: from channel import Channel
 else: Channel = object
@@ -27,16 +28,63 @@ class Retention:
             "size": self.size
         }
 
+class Tiering:
+    path: Optional[str]
+    time: Optional[int]
+    size: Optional[int]
+    rate: Optional[int]
+
+    def __init__(self, obj: Optional[dict] = None):
+        self.path = None
+        self.time = None
+        self.size = None
+        self.rate = None
+        if obj is not None:
+            if "path" in obj and type(obj["path"]) == str: self.path = obj["path"]
+            if "time" in obj and type(obj["time"]) == int: self.time = obj["time"]
+            if "size" in obj and type(obj["size"]) == int: self.size = obj["size"]
+            if "rate" in obj and type(obj["rate"]) == int: self.rate = obj["rate"]
+
+    def _dump(self) -> dict:
+        return {
+            "path": self.path,
+            "time": self.time,
+            "size": self.size,
+            "rate": self.rate
+        }
+
+class RateLimit:
+    rate: float
+    burst: int
+
+    def __init__(self, obj: Optional[dict] = None):
+        self.rate = 60
+        self.burst = 1
+        if obj is not None:
+            if "rate" in obj and type(obj["rate"]) in (int, float) and obj["rate"] > 0: self.rate = obj["rate"]
+            if "burst" in obj and type(obj["burst"]) == int and obj["burst"] >= 1: self.burst = obj["burst"]
+
+    def _dump(self) -> dict:
+        return {
+            "rate": self.rate,
+            "burst": self.burst
+        }
+
 class Config:
     saveDir: str
     serverPort: int
     defaultRetention: Retention
     globalRetention: Retention
+    coldStorage: Tiering
     channels: dict[str, Channel]
     pollInterval: int
     remuxRecordings: bool
     remuxFormat: str
     logLevel: str
+    clusterStore: Optional[str]
+    nodeName: Optional[str]
+    rateLimits: dict[str, RateLimit]
+    clipCacheSize: int
 
     db: sqlite3.Connection
 
@@ -45,11 +93,16 @@ class Config:
         self.serverPort = 6334
         self.defaultRetention = Retention()
         self.globalRetention = Retention()
+        self.coldStorage = Tiering()
         self.channels = {}
         self.pollInterval = 60
         self.remuxRecordings = True
         self.remuxFormat = "mp4"
         self.logLevel = "INFO"
+        self.clusterStore = None
+        self.nodeName = None
+        self.rateLimits = {}
+        self.clipCacheSize = 1000
 
     def load(self, path: str):
         try:
@@ -66,8 +119,72 @@ class Config:
             self.remuxRecordings = dict["remuxRecordings"]
             self.remuxFormat = dict["remuxFormat"]
             self.logLevel = dict["logLevel"] if "logLevel" in dict else "INFO"
+            self.clusterStore = dict["clusterStore"] if "clusterStore" in dict else None
+            self.nodeName = dict["nodeName"] if "nodeName" in dict else None
+            self.rateLimits = {k: RateLimit(v) for k, v in dict["rateLimits"].items()} if "rateLimits" in dict else {}
+            self.clipCacheSize = dict["clipCacheSize"] if "clipCacheSize" in dict else 1000
+            self.coldStorage = Tiering(dict["coldStorage"]) if "coldStorage" in dict else Tiering()
         except FileNotFoundError: pass
 
+    def reload(self, path: str) -> list[str]:
+        """
+        Reloads the config file from disk, applying only what changed since the
+        last load. Unchanged channels are left alone, and changed channels are
+        updated in place, so ongoing recordings are not interrupted.
+
+        :param path: The path to the config file
+        :returns: A list of descriptions of the changes that were applied
+        """
+        dict = {}
+        with open(path, "r") as file:
+            dict = json.load(file)
+        channel = importlib.import_module("channel")
+        # Check and build everything first, so a malformed file doesn't get
+        # half-applied
+        for key, valid, kind in (
+            ("saveDir", lambda v: type(v) == str, "a string"),
+            ("serverPort", lambda v: type(v) == int, "an integer"),
+            ("pollInterval", lambda v: type(v) == int and v > 0, "a positive integer"),
+            ("remuxRecordings", lambda v: type(v) == bool, "a boolean"),
+            ("remuxFormat", lambda v: type(v) == str, "a string"),
+            ("logLevel", lambda v: type(v) == str and type(logging.getLevelName(v)) == int, "a log level"),
+            ("clusterStore", lambda v: v is None or type(v) == str, "a string"),
+            ("nodeName", lambda v: v is None or type(v) == str, "a string"),
+            ("clipCacheSize", lambda v: type(v) == int and v > 0, "a positive integer"),
+        ):
+            if key in dict and not valid(dict[key]): raise ValueError(f"'{key}' not {kind}")
+        newChannels = {k: channel.Channel(obj=c) for k, c in dict["channels"].items()} if "channels" in dict else None
+        newRetention = {k: Retention(dict[k]) for k in ("defaultRetention", "globalRetention") if k in dict}
+        newRateLimits = {k: RateLimit(v) for k, v in dict["rateLimits"].items()} if "rateLimits" in dict else None
+        newColdStorage = Tiering(dict["coldStorage"]) if "coldStorage" in dict else None
+        changes = []
+        for key in ("saveDir", "serverPort", "pollInterval", "remuxRecordings", "remuxFormat", "logLevel", "clusterStore", "nodeName", "clipCacheSize"):
+            if key in dict and dict[key] != getattr(self, key):
+                changes.append(f"{key} changed to {dict[key]}" + (" (takes effect on restart)" if key in ("serverPort", "clusterStore", "nodeName") else ""))
+                setattr(self, key, dict[key])
+        for key, retention in newRetention.items():
+            if retention._dump() != getattr(self, key)._dump():
+                changes.append(f"{key} changed")
+                setattr(self, key, retention)
+        if newRateLimits is not None and {k: v._dump() for k, v in newRateLimits.items()} != {k: v._dump() for k, v in self.rateLimits.items()}:
+            changes.append("rateLimits changed")
+            self.rateLimits = newRateLimits
+        if newColdStorage is not None and newColdStorage._dump() != self.coldStorage._dump():
+            changes.append("coldStorage changed")
+            self.coldStorage = newColdStorage
+        if newChannels is not None:
+            for name in [k for k in self.channels if k not in newChannels]:
+                del self.channels[name]
+                changes.append(f"Removed channel {name}")
+            for name, c in newChannels.items():
+                if name not in self.channels:
+                    self.channels[name] = c
+                    changes.append(f"Added channel {name}")
+                elif c._dump() != self.channels[name]._dump():
+                    self.channels[name]._load(dict["channels"][name])
+                    changes.append(f"Updated channel {name}")
+        return changes
+
     def _dump(self, partial: bool = False) -> dict:
         if partial:
             return {
@@ -75,23 +192,47 @@ class Config:
                 "serverPort": self.serverPort,
                 "defaultRetention": self.defaultRetention._dump(),
                 "globalRetention": self.globalRetention._dump(),
+                "coldStorage": self.coldStorage._dump(),
                 "pollInterval": self.pollInterval,
                 "remuxRecordings": self.remuxRecordings,
                 "remuxFormat": self.remuxFormat,
                 "logLevel": self.logLevel,
+                "clusterStore": self.clusterStore,
+                "nodeName": self.nodeName,
+                "rateLimits": {k: v._dump() for k, v in self.rateLimits.items()},
+                "clipCacheSize": self.clipCacheSize,
             }
         return {
             "saveDir": self.saveDir,
             "serverPort": self.serverPort,
             "defaultRetention": self.defaultRetention._dump(),
             "globalRetention": self.globalRetention._dump(),
+            "coldStorage": self.coldStorage._dump(),
             "channels": {k: channel._dump() for k, channel in self.channels.items()},
             "pollInterval": self.pollInterval,
             "remuxRecordings": self.remuxRecordings,
             "remuxFormat": self.remuxFormat,
             "logLevel": self.logLevel,
+            "clusterStore": self.clusterStore,
+            "nodeName": self.nodeName,
+            "rateLimits": {k: v._dump() for k, v in self.rateLimits.items()},
+            "clipCacheSize": self.clipCacheSize,
         }
 
+    def resolve(self, filename: str) -> str:
+        """
+        Returns the full path to a recording file. Files are looked up in
+        saveDir first, and then in cold storage if they've been migrated.
+
+        :param filename: The path of the file, relative to saveDir
+        :returns: The path to the file on disk
+        """
+        path = self.saveDir + "/" + filename
+        if self.coldStorage.path is not None and not os.path.exists(path):
+            cold = self.coldStorage.path + "/" + filename
+            if os.path.exists(cold): return cold
+        return path
+
     def dumps(self) -> str:
         return json.dumps(self._dump(), indent=4)
 
@@ -0,0 +1,236 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+from config import LOG, config
+import datetime
+import hashlib
+import json
+import os
+import subprocess
+import threading
+import time
+
+PREVIEW_WORKERS = 1
+PREVIEW_INTERVAL = 10
+SPRITE_COLUMNS = 10
+SPRITE_ROWS = 10
+THUMB_WIDTH = 160
+THUMB_HEIGHT = 90
+# Seconds of video covered by one sprite sheet
+SHEET_LENGTH = PREVIEW_INTERVAL * SPRITE_COLUMNS * SPRITE_ROWS
+# Blobs newer than this are never swept, since they may be about to be added
+# to a manifest
+SWEEP_GRACE = 3600
+# Seconds to wait before retrying a recording whose previews failed
+FAILURE_BACKOFF = 3600
+
+_pending: set[str] = set()
+_done: set[str] = set()
+_failed: dict[str, float] = {}
+# Whether any blobs may have lost their last reference since the last sweep
+_dirty = False
+_lock = threading.Lock()
+
+def _lower_priority():
+    # On Linux this only affects the worker thread and the ffmpeg processes it starts
+    if hasattr(os, "nice"): os.nice(10)
+
+_executor = ThreadPoolExecutor(max_workers=PREVIEW_WORKERS, thread_name_prefix="Preview", initializer=_lower_priority)
+
+def cache_dir() -> str:
+    return config.saveDir + "/.cache/previews"
+
+def blob_path(hash: str) -> str:
+    return cache_dir() + "/blobs/" + hash + ".jpg"
+
+def get_key(platform: str, channel: str, timestamp: int) -> str:
+    """
+    Returns the key that identifies a recording's previews.
+    """
+    return hashlib.sha1(f"{platform}\0{channel}\0{timestamp}".encode("utf8")).hexdigest()
+
+def get_manifest(key: str) -> Optional[dict[str, Any]]:
+    """
+    Returns the manifest listing a recording's poster and sprite sheets, or
+    None if nothing has been generated yet.
+
+    :param key: The key returned by `get_key`
+    """
+    try:
+        with open(cache_dir() + "/" + key + ".json", "r") as file: return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError): return None
+
+def _save_manifest(key: str, manifest: dict[str, Any]):
+    path = cache_dir() + "/" + key + ".json"
+    with open(path + ".tmp", "w") as file: json.dump(manifest, file)
+    os.replace(path + ".tmp", path)
+
+def _store(temp: str) -> str:
+    """
+    Moves a generated image into the content-addressed store.
+
+    :returns: The hash of the image
+    """
+    with open(temp, "rb") as file: hash = hashlib.sha256(file.read()).hexdigest()
+    if os.path.exists(blob_path(hash)):
+        os.remove(temp)
+        # Keep the blob from being swept before its manifest is saved
+        os.utime(blob_path(hash))
+    else: os.replace(temp, blob_path(hash))
+    return hash
+
+def _mark_dirty():
+    global _dirty
+    with _lock: _dirty = True
+
+def _sweep():
+    referenced = set()
+    if not os.path.isdir(cache_dir() + "/blobs"): return
+    with os.scandir(cache_dir()) as it:
+        for entry in it:
+            if not entry.name.endswith(".json"): continue
+            manifest = get_manifest(entry.name.removesuffix(".json"))
+            if manifest is None: continue
+            referenced.add(manifest["poster"])
+            referenced.update(manifest["sheets"])
+    cutoff = time.time() - SWEEP_GRACE
+    removed = 0
+    with os.scandir(cache_dir() + "/blobs") as it:
+        for entry in it:
+            if entry.name.removesuffix(".jpg") in referenced or entry.stat().st_mtime > cutoff: continue
+            try:
+                os.remove(entry.path)
+                removed += 1
+            except OSError: pass
+    LOG.debug(f"Removed {removed} unused preview images")
+
+def sweep():
+    """
+    Removes images that are no longer used by any recording's previews.
+    Images are shared between recordings with identical frames, so they're
+    only removed once nothing refers to them. This only does any work if
+    previews were removed or replaced since the last sweep.
+    """
+    global _dirty
+    with _lock:
+        if not _dirty: return
+        _dirty = False
+    # Runs in the preview workers, so it doesn't race with generation
+    _executor.submit(_sweep)
+
+def _duration(input: str) -> float:
+    res = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", input], capture_output=True, text=True, check=True)
+    return float(res.stdout.strip())
+
+def _frame(input: str, output: str, start: float, length: float, filter: str, keyframes: bool = False):
+    import ffmpeg
+    options: dict[str, Any] = {"ss": start, "t": length}
+    # Only decoding keyframes is much faster, and close enough for thumbnails
+    if keyframes: options["skip_frame"] = "nokey"
+    (ffmpeg
+        .input(filename=input, extra_options=options)
+        .output(filename=output, extra_options={"vf": filter, "frames:v": 1, "q:v": 5, "y": True, "loglevel": "error", "hide_banner": True})).run()
+
+def _generate(key: str, filename: str, timestamp: int, in_progress: bool):
+    try:
+        manifest = get_manifest(key) or {"poster": None, "sheets": [], "duration": 0, "complete": False}
+        if not in_progress and manifest["complete"]:
+            with _lock: _done.add(key)
+            return
+        input = config.resolve(filename)
+        if not os.path.exists(input): input += ".part"
+        if not os.path.exists(input): return
+        # Ongoing recordings are only processed up to a little before the
+        # live edge, where all segments have been written
+        if in_progress: duration = max(datetime.datetime.now().timestamp() - timestamp - 30, 0)
+        else: duration = _duration(input)
+        if duration <= 0: return
+        os.makedirs(cache_dir() + "/blobs", exist_ok=True)
+        temp = cache_dir() + "/" + key + ".tmp.jpg"
+        if manifest["poster"] is None and (duration >= 60 or not in_progress):
+            _frame(input, temp, min(duration / 10, 60), duration, f"scale={THUMB_WIDTH * 4}:-2")
+            manifest["poster"] = _store(temp)
+        # Full sheets never change, so each one is only generated once. While
+        # recording, only full sheets are made; the last, partial one is left
+        # until the recording is finished.
+        first = int(manifest["duration"] // SHEET_LENGTH)
+        if in_progress:
+            last = int(duration // SHEET_LENGTH)
+            duration = last * SHEET_LENGTH
+        else: last = int(-(-duration // SHEET_LENGTH))
+        for i in range(first, last):
+            _frame(input, temp, i * SHEET_LENGTH, min(SHEET_LENGTH, duration - i * SHEET_LENGTH), f"fps=1/{PREVIEW_INTERVAL},scale={THUMB_WIDTH}:{THUMB_HEIGHT},tile={SPRITE_COLUMNS}x{SPRITE_ROWS}", True)
+            hash = _store(temp)
+            if i < len(manifest["sheets"]):
+                if manifest["sheets"][i] != hash: _mark_dirty()
+                manifest["sheets"][i] = hash
+            else: manifest["sheets"].append(hash)
+        manifest["duration"] = duration
+        manifest["complete"] = not in_progress
+        _save_manifest(key, manifest)
+        if manifest["complete"]:
+            with _lock: _done.add(key)
+    except Exception as e:
+        LOG.warning(f"Could not generate previews for {filename}: {e}")
+        with _lock: _failed[key] = time.monotonic()
+    finally:
+        with _lock: _pending.discard(key)
+
+def schedule(platform: str, channel: str, timestamp: int, filename: str, in_progress: bool):
+    """
+    Queues preview generation for a recording, if it needs any. Ongoing
+    recordings are updated incrementally each time they're scheduled, and
+    finished recordings are processed once.
+
+    :param platform: The platform of the recording
+    :param channel: The channel of the recording
+    :param timestamp: The timestamp of the recording
+    :param filename: The path of the recording, relative to saveDir
+    :param in_progress: Whether the recording is ongoing
+    """
+    key = get_key(platform, channel, timestamp)
+    with _lock:
+        if key in _pending or (key in _done and not in_progress): return
+        if key in _failed:
+            if time.monotonic() - _failed[key] < FAILURE_BACKOFF: return
+            del _failed[key]
+        _pending.add(key)
+    _executor.submit(_generate, key, filename, timestamp, in_progress)
+
+def forget(platform: str, channel: str, timestamp: int):
+    """
+    Removes the previews for a recording, when it's deleted.
+
+    :param platform: The platform of the recording
+    :param channel: The channel of the recording
+    :param timestamp: The timestamp of the recording
+    """
+    key = get_key(platform, channel, timestamp)
+    try: os.remove(cache_dir() + "/" + key + ".json")
+    except OSError: pass
+    _mark_dirty()
+    with _lock:
+        _done.discard(key)
+        _failed.pop(key, None)
+
+def get_vtt(key: str) -> Optional[str]:
+    """
+    Returns a WebVTT file mapping times in a recording to thumbnails in its
+    sprite sheets, or None if there are no previews yet.
+
+    :param key: The key returned by `get_key`
+    """
+    manifest = get_manifest(key)
+    if manifest is None or len(manifest["sheets"]) == 0: return None
+    def time(t: float) -> str: return "%02d:%02d:%06.3f" % (t // 3600, t // 60 % 60, t % 60)
+    lines = ["WEBVTT", ""]
+    per_sheet = SPRITE_COLUMNS * SPRITE_ROWS
+    n = 0
+    while n * PREVIEW_INTERVAL < manifest["duration"] and n // per_sheet < len(manifest["sheets"]):
+        hash = manifest["sheets"][n // per_sheet]
+        x = n % per_sheet % SPRITE_COLUMNS * THUMB_WIDTH
+        y = n % per_sheet // SPRITE_COLUMNS * THUMB_HEIGHT
+        lines.append(f"{time(n * PREVIEW_INTERVAL)} --> {time(min((n + 1) * PREVIEW_INTERVAL, manifest['duration']))}")
+        lines.append(f"/previews/blobs/{hash}.jpg#xywh={x},{y},{THUMB_WIDTH},{THUMB_HEIGHT}")
+        lines.append("")
+        n += 1
+    return "\n".join(lines)
@@ -0,0 +1,92 @@
+from config import LOG
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+
+SAMPLE_INTERVAL = 0.01
+MAX_PROFILE_LENGTH = 300
+# Seconds the event loop may be blocked before its stack is logged
+LOOP_STALL_THRESHOLD = 0.5
+LOOP_CHECK_INTERVAL = 0.1
+
+_profiling = threading.Lock()
+_beat = time.monotonic()
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    # Semicolons separate frames in the folded format
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+
+def _stack(frame) -> list[str]:
+    stack = []
+    while frame is not None:
+        stack.append(_frame_name(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+def running() -> bool:
+    """
+    Returns whether a profile is being taken.
+    """
+    return _profiling.locked()
+
+def sample(seconds: float) -> str:
+    """
+    Samples the stacks of all threads (including recording threads) for a
+    number of seconds. Samples are taken by wall-clock time, so threads
+    waiting on I/O or locks show up where they're waiting. This blocks, so it
+    must not be called from the main thread.
+
+    :param seconds: The number of seconds to sample for
+    :returns: The profile in folded stack format, as read by flamegraph.pl, speedscope, etc.
+    """
+    if not _profiling.acquire(blocking=False): raise RuntimeError("A profile is already being taken")
+    try:
+        LOG.info(f"Profiling for {seconds:g}s")
+        me = threading.get_ident()
+        counts: dict[str, int] = {}
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid == me: continue
+                key = ";".join([names.get(tid, str(tid)).replace(";", ",")] + _stack(frame))
+                counts[key] = counts.get(key, 0) + 1
+            time.sleep(SAMPLE_INTERVAL)
+        return "".join(f"{k} {v}\n" for k, v in sorted(counts.items()))
+    finally: _profiling.release()
+
+def _watch_loop(tid: int, stopped: threading.Event):
+    reported = None
+    while not stopped.wait(LOOP_CHECK_INTERVAL):
+        beat = _beat
+        blocked = time.monotonic() - beat
+        # Only log each stall once, at the point it crosses the threshold
+        if blocked < LOOP_STALL_THRESHOLD + LOOP_CHECK_INTERVAL or reported == beat: continue
+        reported = beat
+        frame = sys._current_frames().get(tid)
+        if frame is None: continue
+        LOG.warning(f"Event loop blocked for over {blocked:.1f}s at:\n" + "".join(traceback.format_stack(frame)).rstrip())
+
+async def loop_watchdog(shutdown: asyncio.Event):
+    """
+    Logs the stack of the event loop whenever it's blocked for longer than
+    `LOOP_STALL_THRESHOLD`. The loop updates a heartbeat, and a separate
+    thread checks that it keeps up.
+
+    This must be called from the main thread.
+
+    :param shutdown: The event that stops the watchdog when set
+    """
+    global _beat
+    stopped = threading.Event()
+    threading.Thread(target=_watch_loop, name="Event loop watchdog", args=[threading.get_ident(), stopped], daemon=True).start()
+    try:
+        while not shutdown.is_set():
+            _beat = time.monotonic()
+            await asyncio.sleep(LOOP_CHECK_INTERVAL)
+    finally: stopped.set()
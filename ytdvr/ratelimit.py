@@ -0,0 +1,185 @@
+from email.utils import parsedate_to_datetime
+from typing import Optional
+from config import LOG, config
+import datetime
+import threading
+import time
+
+# The rate used for platforms without a limit, which only need to back off
+UNLIMITED_RATE = 6000
+# Messages from platforms that mean "slow down" rather than "not live"
+THROTTLE_MESSAGES = ("HTTP Error 429", "Too Many Requests", "confirm you're not a bot", "confirm you’re not a bot", "rate limit")
+
+class TokenBucket:
+    """
+    A token bucket limiting the request rate for a platform, shared between
+    threads. Requests wait for a token, and while the platform has asked to
+    back off (with Retry-After), requests are refused outright.
+    """
+    rate: float
+    burst: int
+
+    _tokens: float
+    _updated: float
+    _blocked: float
+    _lock: threading.Lock
+
+    def __init__(self, rate: float, burst: int):
+        """
+        Creates a new bucket, starting full.
+
+        :param rate: The number of requests allowed per minute
+        :param burst: The maximum number of requests allowed at once
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._blocked = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> Optional[float]:
+        """
+        Takes a token from the bucket, waiting until one is available. This
+        blocks, so it must not be called from the main thread.
+
+        :returns: The number of seconds spent waiting, or None if the platform is backing off
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._blocked: return None
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate / 60)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) * 60 / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def block(self, seconds: float):
+        """
+        Holds all requests for a number of seconds, and empties the bucket.
+
+        :param seconds: The number of seconds to wait
+        """
+        with self._lock:
+            self._blocked = max(self._blocked, time.monotonic() + seconds)
+            self._tokens = 0
+
+    def _dump(self) -> dict:
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "tokens": self._tokens,
+            "blocked_for": max(self._blocked - time.monotonic(), 0)
+        }
+
+buckets: dict[str, TokenBucket] = {}
+stats: dict[str, dict[str, int]] = {}
+_lock = threading.Lock()
+
+def get_bucket(platform: str) -> Optional[TokenBucket]:
+    """
+    Returns the bucket for a platform, or None if it isn't limited. A limit
+    configured for a platform also applies to extractors whose names start
+    with it (e.g. `Youtube` covers `YoutubeTab`).
+
+    :param platform: The yt-dlp extractor key for the platform
+    """
+    keys = [k for k in config.rateLimits if platform.startswith(k)]
+    if len(keys) == 0:
+        # Platforms without a limit may still have a back-off bucket
+        with _lock: return buckets.get(platform)
+    key = max(keys, key=len)
+    limit = config.rateLimits[key]
+    with _lock:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(limit.rate, limit.burst)
+        else:
+            # Pick up changes from config reloads
+            bucket.rate = limit.rate
+            bucket.burst = limit.burst
+    return bucket
+
+def acquire(platform: str) -> bool:
+    """
+    Waits until a request to a platform is allowed. This blocks, so it must
+    not be called from the main thread.
+
+    :param platform: The yt-dlp extractor key for the platform
+    :returns: Whether the request may be made, or False if the platform asked to back off
+    """
+    bucket = get_bucket(platform)
+    if bucket is None: return True
+    waited = bucket.acquire()
+    if waited is None: return False
+    if waited > 0: LOG.debug(f"Waited {waited:.1f}s for {platform} rate limit")
+    return True
+
+def record(platform: str, result: str):
+    """
+    Counts the result of a request to a platform.
+
+    :param platform: The yt-dlp extractor key for the platform
+    :param result: The kind of result (`live`, `offline`, `throttled`, `download`)
+    """
+    with _lock:
+        counts = stats.setdefault(platform, {"live": 0, "offline": 0, "throttled": 0, "download": 0})
+        counts[result] += 1
+
+def check_throttled(e: BaseException) -> tuple[bool, Optional[float]]:
+    """
+    Checks whether an error from yt-dlp was caused by the platform throttling
+    requests, as opposed to the stream being offline.
+
+    :param e: The error that was raised
+    :returns: Whether the error is throttling, and the number of seconds to wait if the platform gave one
+    """
+    seen = set()
+    err: Optional[BaseException] = e
+    while err is not None and id(err) not in seen:
+        seen.add(id(err))
+        status = getattr(err, "status", None) or getattr(err, "code", None)
+        if status == 429:
+            response = getattr(err, "response", None)
+            headers = getattr(response, "headers", None) or getattr(err, "headers", None)
+            return True, _parse_retry_after(headers.get("Retry-After") if headers is not None else None)
+        exc_info = getattr(err, "exc_info", None)
+        err = (exc_info[1] if exc_info else None) or err.__cause__ or err.__context__
+    message = str(e)
+    return any(m in message for m in THROTTLE_MESSAGES), None
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if value is None: return None
+    try: return max(float(value), 0)
+    except ValueError: pass
+    try: return max((parsedate_to_datetime(value) - datetime.datetime.now(datetime.UTC)).total_seconds(), 0)
+    except (TypeError, ValueError): return None
+
+def throttled(platform: str, retry_after: Optional[float]):
+    """
+    Records that a platform throttled a request, and backs off all requests
+    to it for the time given, or one poll interval if none was given.
+
+    :param platform: The yt-dlp extractor key for the platform
+    :param retry_after: The number of seconds the platform asked to wait
+    """
+    record(platform, "throttled")
+    delay = retry_after if retry_after is not None else config.pollInterval
+    LOG.warning(f"{platform} is throttling requests, backing off for {delay:.0f}s")
+    bucket = get_bucket(platform)
+    if bucket is None:
+        # Honor the back-off even if the platform has no configured limit
+        with _lock: bucket = buckets.setdefault(platform, TokenBucket(UNLIMITED_RATE, UNLIMITED_RATE))
+    bucket.block(delay)
+
+def _dump() -> dict:
+    with _lock:
+        return {
+            "buckets": {k: b._dump() for k, b in buckets.items()},
+            "stats": {k: dict(v) for k, v in stats.items()}
+        }
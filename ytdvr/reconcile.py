@@ -0,0 +1,195 @@
+from typing import Any, Optional
+from config import LOG, config
+import asyncio
+import channel as channels
+import datetime
+import os
+import re
+
+MEDIA_EXTENSIONS = (".ts", ".mp4", ".mkv", ".webm", ".flv", ".mov", ".m4a", ".mp3", ".ogg", ".opus")
+filename_regex = re.compile("^(\\d{4}-\\d{2}-\\d{2} \\d{2}-\\d{2}-\\d{2}) - (.+)$")
+# Reconciliation won't remove more than this fraction of the database at
+# once (beyond a few recordings), since that's more likely a storage problem
+# than deleted files
+MAX_REMOVED_FRACTION = 0.25
+MAX_REMOVED_UNCHECKED = 10
+# Later parts of a recording that was restarted, named `<stem>.<n>.ts`
+part_regex = re.compile("^(.+)\\.\\d+$")
+
+status: dict[str, Any] = {
+    "running": False,
+    "started": None,
+    "finished": None,
+    "directories": 0,
+    "scanned": 0,
+    "adopted": 0,
+    "repaired": 0,
+    "removed": 0
+}
+
+def _media_stem(name: str) -> Optional[str]:
+    """
+    Returns the name of a media file without its extension (and .part suffix),
+    or None if the file isn't a recording.
+    """
+    name = name.removesuffix(".part")
+    for ext in MEDIA_EXTENSIONS:
+        if name.endswith(ext): return name.removesuffix(ext)
+    return None
+
+def _roots() -> list[str]:
+    return [config.saveDir] + ([config.coldStorage.path] if config.coldStorage.path is not None else [])
+
+def _scan(channel: str) -> Optional[list[str]]:
+    """
+    Lists the files for a channel across all storage tiers, or returns None
+    if the channel has no directory in any of them.
+    """
+    files = []
+    found = False
+    for root in _roots():
+        try:
+            with os.scandir(root + "/" + channel) as it:
+                files += [entry.name for entry in it if entry.is_file() and not entry.name.endswith(".tmp")]
+            found = True
+        except (FileNotFoundError, NotADirectoryError): pass
+    return list(dict.fromkeys(files)) if found else None
+
+def _missing(filename: str) -> bool:
+    return not os.path.exists(config.resolve(filename)) and not os.path.exists(config.saveDir + "/" + filename + ".part")
+
+def _channel_dirs() -> list[str]:
+    dirs = []
+    for root in _roots():
+        try:
+            with os.scandir(root) as it:
+                dirs += [entry.name for entry in it if entry.is_dir() and not entry.name.startswith(".")]
+        except FileNotFoundError: pass
+    return list(dict.fromkeys(dirs))
+
+def _adopt(channel: str, name: str, files: set[str], taken: set[int]) -> channels.Recording:
+    """
+    Creates a recording for a file on disk that has no database entry.
+    """
+    path = config.resolve(channel + "/" + name)
+    stem = _media_stem(name) or name
+    m = filename_regex.match(stem)
+    if m:
+        title = m.group(2)
+        timestamp = int(datetime.datetime.strptime(m.group(1), "%Y-%m-%d %H-%M-%S").timestamp())
+    else:
+        title = stem
+        timestamp = int(os.path.getmtime(path))
+    while timestamp in taken: timestamp += 1
+    taken.add(timestamp)
+    if name.endswith(".part"):
+        # Leftover from a crashed recording - keep whatever was written
+        os.rename(path, path.removesuffix(".part"))
+        name = name.removesuffix(".part")
+    c = config.channels.get(channel)
+    return channels.Recording(
+        (c.platform if c is not None else None) or "Unknown", channel, title, timestamp,
+        c.url if c is not None else "",
+        channel + "/" + name,
+        next((channel + "/" + stem + ext for ext in (".txt.gz", ".txt") if stem + ext in files), None))
+
+async def reconcile():
+    """
+    Cross-checks the video database against the files in saveDir. Partial
+    recordings are remuxed, entries whose files are gone are removed, and
+    recordings on disk without a database entry are adopted.
+
+    This must be called from the main thread. Directory scans and remuxes run
+    in worker threads, so the web server stays responsive.
+    """
+    if status["running"]: return
+    status.update({"running": True, "started": int(datetime.datetime.now().timestamp()), "finished": None, "directories": 0, "scanned": 0, "adopted": 0, "repaired": 0, "removed": 0})
+    try:
+        LOG.info("Reconciling database with " + config.saveDir)
+        # An unmounted volume looks just like one with every recording deleted
+        for root in _roots():
+            if not await asyncio.to_thread(os.path.isdir, root):
+                LOG.error(f"{root} does not exist or is not mounted, skipping reconciliation")
+                return
+        rows = config.db.execute("SELECT platform, channel, title, timestamp, url, filename, chat_filename, in_progress FROM videos").fetchall()
+        dirs = set(await asyncio.to_thread(_channel_dirs)) | set(row[1] for row in rows)
+        status["directories"] = len(dirs)
+        async def scan(channel: str):
+            files = await asyncio.to_thread(_scan, channel)
+            status["scanned"] += 1
+            return channel, files
+        scanned = dict(await asyncio.gather(*[scan(c) for c in dirs]))
+        listing = {c: set(files or []) for c, files in scanned.items()}
+        missing = []
+
+        known = {(r.platform, r.channel, r.timestamp): r for r in channels.recordings}
+        claimed: dict[str, set[str]] = {c: set() for c in dirs}
+        for platform, channel, title, timestamp, url, filename, chat_filename, in_progress in rows:
+            r = known.get((platform, channel, timestamp))
+            if r is not None and r.in_progress: continue
+            if r is None:
+                r = channels.Recording(platform, channel, title, timestamp, url, filename, chat_filename)
+                channels.recordings.append(r)
+            files = listing[channel]
+            name = os.path.basename(filename)
+            if chat_filename is not None: claimed[channel].add(os.path.basename(chat_filename))
+            partial = name not in files and name + ".part" in files
+            if partial or (in_progress != 0 and name in files):
+                LOG.warning(f"Detected partial video at {filename}, remuxing")
+                await asyncio.to_thread(r.stitch)
+                await asyncio.to_thread(r.remux)
+                r.update()
+                claimed[channel].add(_media_stem(os.path.basename(r.filename)) or "")
+                status["repaired"] += 1
+            elif name not in files:
+                if scanned[channel] is None: LOG.warning(f"Directory for {channel} is missing, not checking {filename}")
+                else: missing.append(r)
+            else: claimed[channel].add(_media_stem(name) or name)
+
+        # Directory listings can be stale, so check each file again before
+        # giving up on it
+        missing = [r for r in missing if await asyncio.to_thread(_missing, r.filename)]
+        if len(missing) > MAX_REMOVED_UNCHECKED and len(missing) > len(rows) * MAX_REMOVED_FRACTION:
+            LOG.error(f"{len(missing)} of {len(rows)} recordings are missing from disk, which looks like a storage problem; not removing them")
+        else:
+            for r in missing:
+                LOG.warning(f"Recording {r.filename} is missing from disk, removing from database")
+                config.db.execute("DELETE FROM videos WHERE platform = ? AND channel = ? AND timestamp = ?", (r.platform, r.channel, r.timestamp))
+                config.db.commit()
+                channels.recordings.remove(r)
+                status["removed"] += 1
+
+        # Active recordings own their files, whatever state they're in
+        active: dict[str, set[str]] = {c: set() for c in dirs}
+        for r in channels.recordings:
+            if r.in_progress and r.channel in dirs: active[r.channel].add(_media_stem(os.path.basename(r.filename)) or "")
+        for channel, files in listing.items():
+            taken = set(r.timestamp for r in channels.recordings if r.channel == channel)
+            for name in sorted(files):
+                stem = _media_stem(name)
+                if stem is None or stem in active[channel]: continue
+                part = part_regex.match(stem)
+                if part is not None and (part.group(1) in active[channel] or part.group(1) in claimed[channel]): continue
+                if stem in claimed[channel]:
+                    if name.endswith(".part") and name.removesuffix(".part") in files:
+                        # The finished file is already there, so this is just a leftover
+                        LOG.info(f"Removing leftover partial file {channel}/{name}")
+                        try: await asyncio.to_thread(os.remove, config.saveDir + "/" + channel + "/" + name)
+                        except OSError: pass
+                    continue
+                LOG.warning(f"Adopting untracked recording {channel}/{name}")
+                try: r = await asyncio.to_thread(_adopt, channel, name, files, taken)
+                except OSError as e:
+                    LOG.error(f"Could not adopt {channel}/{name}: {e}")
+                    continue
+                if name.endswith(".part") and config.remuxRecordings: await asyncio.to_thread(r.remux)
+                claimed[channel].add(stem)
+                r._insert_into_db()
+                channels.recordings.append(r)
+                status["adopted"] += 1
+        LOG.info(f"Reconciliation finished: {status['adopted']} adopted, {status['repaired']} repaired, {status['removed']} removed")
+    except Exception as e:
+        LOG.error("Reconciliation failed: " + str(e))
+    finally:
+        status["running"] = False
+        status["finished"] = int(datetime.datetime.now().timestamp())
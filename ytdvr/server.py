@@ -3,14 +3,22 @@ from config import LOG, config
 import app
 import asyncio
 import channel as channels
+import cluster
 import datetime
 import logging
 import multiprocessing
 import os
+import previews
+import profiling
+import reconcile
 import signal
 import sqlite3
+import tiering
+import time
+import tsindex
 
 shutdown_event = asyncio.Event()
+CONFIG_WATCH_INTERVAL = 5
 
 def _signal_handler(*_: Any) -> None:
     shutdown_event.set()
@@ -19,7 +27,7 @@ async def retention_watcher():
     while not shutdown_event.is_set():
         LOG.info("Scanning retention for all channels")
         # TODO: should in progress videos be exempt? would complicate code structure
-        for name, channel in config.channels.items():
+        for name, channel in list(config.channels.items()):
             retention = channel.retention or config.defaultRetention
             if retention.count is not None or retention.size is not None or retention.time is not None:
                 videos = [v for v in channels.recordings if v.channel == name]
@@ -34,9 +42,9 @@ async def retention_watcher():
                     total_size = 0
                     for v in videos:
                         try:
-                            try: total_size = total_size + os.path.getsize(config.saveDir + "/" + v.filename)
+                            try: total_size = total_size + os.path.getsize(config.resolve(v.filename))
                             except: total_size = total_size + os.path.getsize(config.saveDir + "/" + v.filename + ".part")
-                            if v.chat_filename is not None: total_size = total_size + os.path.getsize(config.saveDir + "/" + v.chat_filename)
+                            if v.chat_filename is not None: total_size = total_size + os.path.getsize(config.resolve(v.chat_filename))
                         except: pass
                     while len(videos) > 0 and total_size > retention.size * 1000000:
                         LOG.info("Removing recording " + videos[0].title + " (size)")
@@ -65,8 +73,8 @@ async def retention_watcher():
                 total_size = 0
                 for v in videos:
                     try:
-                        total_size = total_size + os.path.getsize(config.saveDir + "/" + v.filename)
-                        if v.chat_filename is not None: total_size = total_size + os.path.getsize(config.saveDir + "/" + v.chat_filename)
+                        total_size = total_size + os.path.getsize(config.resolve(v.filename))
+                        if v.chat_filename is not None: total_size = total_size + os.path.getsize(config.resolve(v.chat_filename))
                     except: pass
                 while len(videos) > 0 and total_size > retention.size * 1000000:
                     LOG.info("Removing recording " + videos[0].title + " (size)")
@@ -83,41 +91,143 @@ async def retention_watcher():
                     videos.pop(0)
         await asyncio.sleep(config.pollInterval)
 
+async def preview_watcher():
+    while not shutdown_event.is_set():
+        for r in list(channels.recordings):
+            # Previews follow the recording's timeline, which the later parts
+            # of a restarted recording only rejoin once they're stitched
+            if r.in_progress and r.part > 0: continue
+            previews.schedule(r.platform, r.channel, r.timestamp, r.filename, r.in_progress)
+        previews.sweep()
+        try: await asyncio.wait_for(shutdown_event.wait(), timeout=config.pollInterval)
+        except TimeoutError: pass
+
+async def index_watcher():
+    # Seek indexes are kept up to date while recording, so opening a long
+    # recording doesn't have to scan all of it at once
+    while not shutdown_event.is_set():
+        for r in [r for r in channels.recordings if r.in_progress and r.filename.endswith(".ts")]:
+            path = config.saveDir + "/" + r.current_filename
+            if not os.path.exists(path): path += ".part"
+            try: await asyncio.to_thread(tsindex.update, path)
+            except Exception as e: LOG.warning(f"Could not index {r.filename}: {e}")
+        try: await asyncio.wait_for(shutdown_event.wait(), timeout=config.pollInterval)
+        except TimeoutError: pass
+
+async def tiering_watcher():
+    while not shutdown_event.is_set():
+        for r in await asyncio.to_thread(tiering.candidates):
+            if shutdown_event.is_set(): break
+            try: await asyncio.to_thread(tiering.migrate_recording, r)
+            except Exception as e: LOG.error(f"Could not move {r.filename} to cold storage: {e}")
+            # If the recording was deleted while it was being copied, the
+            # copy in cold storage is all that's left of it
+            if r not in channels.recordings:
+                for filename in (r.filename, r.chat_filename):
+                    if filename is None: continue
+                    try: os.remove(config.resolve(filename))
+                    except OSError: pass
+        try: await asyncio.wait_for(shutdown_event.wait(), timeout=config.pollInterval)
+        except TimeoutError: pass
+
+async def config_watcher():
+    path = os.getenv("YTDVR_CONFIG") or "ytdvr_config.json"
+    try: mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError: mtime = None
+    while not shutdown_event.is_set():
+        try: await asyncio.wait_for(shutdown_event.wait(), timeout=CONFIG_WATCH_INTERVAL)
+        except TimeoutError: pass
+        try: newtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError: continue
+        if newtime == mtime: continue
+        mtime = newtime
+        try:
+            changes = config.reload(path)
+            LOG.setLevel(config.logLevel)
+        except Exception as e:
+            LOG.error("Could not reload config, keeping current settings: " + str(e))
+            continue
+        for change in changes: LOG.info("Config reload: " + change)
+
+async def cluster_heartbeat():
+    try:
+        while not shutdown_event.is_set():
+            try: await asyncio.to_thread(cluster.coordinator.heartbeat, set(config.channels))
+            except Exception as e: LOG.error(f"Cluster heartbeat failed: {e}")
+            try: await asyncio.wait_for(shutdown_event.wait(), timeout=max(config.pollInterval / 3, 1))
+            except TimeoutError: pass
+    finally: await asyncio.to_thread(cluster.coordinator.leave)
+
+def _load_recordings(path: str) -> list[channels.Recording]:
+    # Uses its own connection, as sqlite connections are tied to their thread
+    db = sqlite3.connect(path)
+    try:
+        res = db.execute("SELECT platform, channel, title, timestamp, url, filename, chat_filename FROM videos")
+        return [channels.Recording(*row) for row in res.fetchall()]
+    finally: db.close()
+
+def _log_phase(name: str, start: float) -> float:
+    now = time.perf_counter()
+    LOG.info(f"Startup: {name} took {(now - start) * 1000:.0f} ms")
+    return now
+
 async def main():
     LOG.info("Starting yt-dvr")
+    start = time.perf_counter()
+    t = start
     config.load(os.getenv("YTDVR_CONFIG") or "ytdvr_config.json")
     config.save(os.getenv("YTDVR_CONFIG") or "ytdvr_config.json")
-    config.db = sqlite3.connect(os.getenv("YTDVR_DB") or "./ytdvr.db")
     LOG.setLevel(config.logLevel)
+    t = _log_phase("loading config", t)
+    db_path = os.getenv("YTDVR_DB") or "./ytdvr.db"
+    config.db = sqlite3.connect(db_path)
     cur = config.db.cursor()
     cur.execute("CREATE TABLE IF NOT EXISTS videos (platform TEXT, channel TEXT, title TEXT, timestamp INTEGER, url TEXT, filename TEXT, chat_filename TEXT, in_progress INTEGER)")
-    res = cur.execute("SELECT platform, channel, title, timestamp, url, filename, chat_filename, in_progress FROM videos")
-    for platform, channel, title, timestamp, url, filename, chat_filename, in_progress in res.fetchall():
-        r = channels.RecordingInfo(platform, channel, title, timestamp, url, filename, chat_filename, False)
-        if in_progress != 0:
-            LOG.warning(f"Detected partial video at {filename}, remuxing")
-            r.remux()
-            r.update()
-        channels.recordings.append(r)
+    t = _log_phase("opening database", t)
+    # Start serving as early as possible. The server only starts once the loop
+    # gets control, so the recordings are loaded in a worker thread while it
+    # does, and show up in the web interface once they're loaded.
+    async def serving(): LOG.info(f"Startup: web interface ready after {(time.perf_counter() - start) * 1000:.0f} ms")
+    app.app.before_serving(serving)
     asyncio.create_task(app.run(config.serverPort, shutdown_event.wait))
+    await asyncio.sleep(0)
+    channels.recordings.extend(await asyncio.to_thread(_load_recordings, db_path))
+    t = _log_phase(f"loading {len(channels.recordings)} recordings", t)
+    # Partial recordings are remuxed by the reconciliation pass
+    asyncio.create_task(reconcile.reconcile())
     asyncio.create_task(retention_watcher())
+    asyncio.create_task(config_watcher())
+    asyncio.create_task(preview_watcher())
+    asyncio.create_task(tiering_watcher())
+    asyncio.create_task(index_watcher())
+    asyncio.create_task(profiling.loop_watchdog(shutdown_event))
+    cluster.coordinator = await asyncio.to_thread(cluster.get_coordinator)
+    asyncio.create_task(cluster_heartbeat())
     signal.signal(signal.SIGINT, _signal_handler)
     multiprocessing.set_start_method("spawn")
     try:
         while not shutdown_event.is_set():
             LOG.info("Checking channels for liveness")
-            for name, channel in config.channels.items():
+            for name, channel in list(config.channels.items()):
                 LOG.debug(f"Checking channel {name}")
                 try:
                     next(r for r in channels.recordings if r.channel == name and r.in_progress)
                 except StopIteration:
-                    ok, arg = await channel.check_live()
-                    if ok:
-                        LOG.info(f"Starting recording for channel {name}")
-                        rec = await channel.download(name, arg)
-                        channels.recordings.append(rec)
-                    else:
-                        LOG.debug(f"Stream {name} is not live")
+                    if not await asyncio.to_thread(cluster.coordinator.acquire, name):
+                        LOG.debug(f"Channel {name} is owned by another node")
+                        continue
+                    try:
+                        ok, arg = await channel.check_live()
+                        if ok:
+                            LOG.info(f"Starting recording for channel {name}")
+                            rec = await channel.download(name, arg)
+                            channels.recordings.append(rec)
+                        elif arg == channels.THROTTLED:
+                            LOG.warning(f"Could not check channel {name}: platform is throttling requests")
+                        else:
+                            LOG.debug(f"Stream {name} is not live")
+                    except Exception as e:
+                        LOG.error(f"Could not check channel {name}: {e}")
             LOG.debug("Done checking")
             try: await asyncio.wait_for(shutdown_event.wait(), timeout=config.pollInterval)
             except TimeoutError: pass
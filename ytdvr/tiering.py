@@ -0,0 +1,105 @@
+from typing import Optional, cast
+from config import LOG, config
+import channel as channels
+import datetime
+import hashlib
+import os
+import time
+import tsindex
+
+CHUNK_SIZE = 1024 * 1024
+
+def _copy(src: str, dst: str, rate: Optional[int]) -> str:
+    """
+    Copies a file, throttled to a rate in MB/s.
+
+    :returns: The SHA-256 hash of the data copied
+    """
+    hash = hashlib.sha256()
+    start = time.monotonic()
+    copied = 0
+    with open(src, "rb") as input, open(dst, "wb") as output:
+        while chunk := input.read(CHUNK_SIZE):
+            output.write(chunk)
+            hash.update(chunk)
+            copied += len(chunk)
+            if rate is not None:
+                ahead = copied / (rate * 1000000) - (time.monotonic() - start)
+                if ahead > 0: time.sleep(ahead)
+        output.flush()
+        os.fsync(output.fileno())
+    return hash.hexdigest()
+
+def _hash(path: str) -> str:
+    hash = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(CHUNK_SIZE): hash.update(chunk)
+    return hash.hexdigest()
+
+def migrate(filename: str) -> bool:
+    """
+    Moves a file from saveDir to cold storage. The file is copied, the copy
+    is verified, and only then is the original removed, so a complete copy
+    exists at every point. This blocks, so it must not be called from the main
+    thread.
+
+    :param filename: The path of the file, relative to saveDir
+    :returns: Whether the file was moved
+    """
+    src = config.saveDir + "/" + filename
+    dst = cast(str, config.coldStorage.path) + "/" + filename
+    if not os.path.exists(src): return False
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        digest = _copy(src, dst + ".tmp", config.coldStorage.rate)
+        if os.path.getsize(dst + ".tmp") != os.path.getsize(src) or _hash(dst + ".tmp") != digest:
+            raise IOError("copy does not match original")
+        os.replace(dst + ".tmp", dst)
+    except:
+        try: os.remove(dst + ".tmp")
+        except OSError: pass
+        raise
+    # The recording may have been deleted in the meantime
+    try: os.remove(src)
+    except FileNotFoundError: pass
+    return True
+
+def _hot_size(r: channels.Recording) -> int:
+    total = 0
+    for filename in (r.filename, r.chat_filename):
+        if filename is None: continue
+        try: total += os.path.getsize(config.saveDir + "/" + filename)
+        except OSError: pass
+    return total
+
+def candidates() -> list[channels.Recording]:
+    """
+    Returns the finished recordings in saveDir that should be moved to cold
+    storage according to the `coldStorage` policy, oldest first. This checks
+    every recording on disk, so it must not be called from the main thread.
+    """
+    tiering = config.coldStorage
+    if tiering.path is None or (tiering.time is None and tiering.size is None): return []
+    videos = [v for v in list(channels.recordings) if not v.in_progress and os.path.exists(config.saveDir + "/" + v.filename)]
+    videos.sort(key=lambda v: v.timestamp)
+    res = []
+    if tiering.time is not None:
+        cutoff = int(datetime.datetime.now().timestamp()) - tiering.time * 86400
+        while len(videos) > 0 and videos[0].timestamp < cutoff: res.append(videos.pop(0))
+    if tiering.size is not None:
+        sizes = [_hot_size(v) for v in videos]
+        total = sum(sizes)
+        while len(videos) > 0 and total > tiering.size * 1000000:
+            res.append(videos.pop(0))
+            total -= sizes.pop(0)
+    return res
+
+def migrate_recording(r: channels.Recording):
+    """
+    Moves a recording and its chat log to cold storage. This blocks, so it
+    must not be called from the main thread.
+    """
+    LOG.info("Moving recording " + r.title + " to cold storage")
+    migrate(r.filename)
+    if os.path.exists(tsindex.index_path(config.saveDir + "/" + r.filename)): migrate(r.filename + ".idx")
+    if r.chat_filename is not None: migrate(r.chat_filename)
@@ -0,0 +1,186 @@
+from typing import Any, Optional
+from urllib.parse import quote
+from config import LOG
+import json
+import math
+import os
+import threading
+
+PACKET_SIZE = 188
+# Minimum length of a playlist segment, in seconds. Segments always start at
+# a keyframe, so they may be longer.
+SEGMENT_LENGTH = 4
+READ_SIZE = PACKET_SIZE * 8192
+PTS_RATE = 90000
+PTS_WRAP = 1 << 33
+# MPEG-2, MPEG-1, MPEG-4 Part 2, H.264 and HEVC
+VIDEO_STREAM_TYPES = (0x02, 0x01, 0x10, 0x1B, 0x24)
+
+_locks: dict[str, threading.Lock] = {}
+_lock = threading.Lock()
+
+def index_path(path: str) -> str:
+    """
+    Returns the path of the seek index for a recording. Recordings in progress
+    share the index of the finished file, which has the same byte offsets.
+
+    :param path: The path to the MPEG-TS file, with or without `.part`
+    """
+    return path.removesuffix(".part") + ".idx"
+
+def remove(path: str):
+    """
+    Removes the seek index for a recording, if it has one. This must be done
+    whenever the file is rewritten.
+
+    :param path: The path to the MPEG-TS file
+    """
+    try: os.remove(index_path(path))
+    except OSError: pass
+
+def _pts(b: bytes) -> int:
+    return ((b[0] >> 1) & 7) << 30 | b[1] << 22 | (b[2] >> 1) << 15 | b[3] << 7 | b[4] >> 1
+
+def _section(payload: bytes) -> tuple[bytes, int]:
+    # Skips the pointer field, and returns the section and where its entries end
+    section = payload[1 + payload[0]:]
+    return section, min(3 + (((section[1] & 0x0F) << 8) | section[2]) - 4, len(section))
+
+def _is_keyframe(stream_type: int, data: bytes) -> bool:
+    # Looks for the parameter sets or IDR slice that start a keyframe, for
+    # streams that don't set the random access indicator
+    i = data.find(b"\x00\x00\x01")
+    while i != -1 and i + 3 < len(data):
+        if stream_type == 0x1B and data[i + 3] & 0x1F in (5, 7): return True
+        if stream_type == 0x24 and (data[i + 3] >> 1) & 0x3F in (16, 17, 18, 19, 20, 21, 32, 33): return True
+        i = data.find(b"\x00\x00\x01", i + 3)
+    return False
+
+def _packet(index: dict[str, Any], packet: bytes, offset: int):
+    pid = ((packet[1] & 0x1F) << 8) | packet[2]
+    start = packet[1] & 0x40
+    control = (packet[3] >> 4) & 3
+    pos = 4
+    random_access = False
+    if control & 2:
+        if packet[4] > 0: random_access = bool(packet[5] & 0x40)
+        pos = 5 + packet[4]
+    if not control & 1 or not start or pos >= PACKET_SIZE: return
+    payload = packet[pos:]
+    try:
+        if pid == 0 and index["pmt_pid"] is None:
+            section, end = _section(payload)
+            for i in range(8, end - 3, 4):
+                if (section[i] << 8) | section[i + 1] != 0:
+                    index["pmt_pid"] = ((section[i + 2] & 0x1F) << 8) | section[i + 3]
+                    break
+        elif pid == index["pmt_pid"] and index["video_pid"] is None:
+            section, end = _section(payload)
+            i = 12 + (((section[10] & 0x0F) << 8) | section[11])
+            while i + 5 <= end:
+                if section[i] in VIDEO_STREAM_TYPES:
+                    index["video_pid"] = ((section[i + 1] & 0x1F) << 8) | section[i + 2]
+                    index["stream_type"] = section[i]
+                    break
+                i += 5 + (((section[i + 3] & 0x0F) << 8) | section[i + 4])
+            index["map"] = offset + PACKET_SIZE
+        elif pid == index["video_pid"] and payload.startswith(b"\x00\x00\x01") and payload[7] & 0x80:
+            pts = _pts(payload[9:14]) + index["wraps"] * PTS_WRAP
+            if index["last_pts"] is not None and pts < index["last_pts"] - PTS_WRAP // 2:
+                index["wraps"] += 1
+                pts += PTS_WRAP
+            if index["first_pts"] is None: index["first_pts"] = pts
+            index["last_pts"] = max(pts, index["last_pts"] or pts)
+            time = (pts - index["first_pts"]) / PTS_RATE
+            keyframes = index["keyframes"]
+            if len(keyframes) > 0 and time < keyframes[-1][0] + SEGMENT_LENGTH: return
+            if random_access or _is_keyframe(index["stream_type"], payload[9 + payload[8]:]):
+                keyframes.append([round(time, 3), offset])
+    except IndexError: pass # truncated tables
+
+def _scan(index: dict[str, Any], file, size: int):
+    file.seek(index["size"])
+    while index["size"] + PACKET_SIZE <= size:
+        base = index["size"]
+        data = file.read(min(READ_SIZE, (size - base) // PACKET_SIZE * PACKET_SIZE))
+        if len(data) < PACKET_SIZE: break
+        length = len(data) // PACKET_SIZE * PACKET_SIZE
+        if index["video_pid"] is None:
+            for i in range(0, length, PACKET_SIZE):
+                if data[i] == 0x47: _packet(index, data[i:i + PACKET_SIZE], base + i)
+        else:
+            # Only the starts of video packets matter from here on, which are
+            # much faster to find than to walk every packet
+            pid = index["video_pid"]
+            header = bytes([0x47, 0x40 | (pid >> 8), pid & 0xFF])
+            i = data.find(header, 0, length)
+            while i != -1:
+                if i % PACKET_SIZE == 0: _packet(index, data[i:i + PACKET_SIZE], base + i)
+                i = data.find(header, i + 1, length)
+        index["size"] = base + length
+
+def update(path: str) -> Optional[dict[str, Any]]:
+    """
+    Brings the seek index for an MPEG-TS recording up to date, scanning only
+    the part of the file added since the last update. The index maps
+    timestamps to the byte offsets of keyframes at least `SEGMENT_LENGTH`
+    seconds apart. This blocks, so it must not be called from the main thread.
+
+    :param path: The path to the MPEG-TS file, with or without `.part`
+    :returns: The index, or None if the file doesn't exist
+    """
+    idx = index_path(path)
+    with _lock: lock = _locks.setdefault(idx, threading.Lock())
+    with lock:
+        try: size = os.path.getsize(path)
+        except OSError: return None
+        index: Optional[dict[str, Any]] = None
+        try:
+            with open(idx, "r") as file: index = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError): pass
+        # A file that shrank was rewritten, so its offsets are no longer valid
+        if index is None or index["size"] > size:
+            index = {"size": 0, "pmt_pid": None, "video_pid": None, "stream_type": None, "map": None, "first_pts": None, "last_pts": None, "wraps": 0, "keyframes": []}
+        if index["size"] + PACKET_SIZE > size: return index
+        try:
+            with open(path, "rb") as file: _scan(index, file, size)
+        except OSError as e:
+            LOG.warning(f"Could not index {path}: {e}")
+            return None
+        with open(idx + ".tmp", "w") as file: json.dump(index, file, separators=(",", ":"))
+        os.replace(idx + ".tmp", idx)
+        return index
+
+def playlist(index: dict[str, Any], name: str, complete: bool) -> Optional[str]:
+    """
+    Generates an HLS playlist that splits a recording into byte ranges at its
+    keyframes, so a player can seek anywhere with a single range request.
+
+    :param index: The index returned by `update`
+    :param name: The URI of the MPEG-TS file, relative to the playlist
+    :param complete: Whether the recording is finished
+    :returns: The playlist, or None if the index has no keyframes
+    """
+    keyframes = index["keyframes"]
+    if len(keyframes) == 0: return None
+    end = (index["last_pts"] - index["first_pts"]) / PTS_RATE
+    segments = []
+    for i, (time, offset) in enumerate(keyframes):
+        # The first segment also covers anything before the first keyframe,
+        # including the program tables
+        if i == 0: offset = 0
+        if i + 1 < len(keyframes): segments.append((keyframes[i + 1][0] - time, offset, keyframes[i + 1][1] - offset))
+        # The last segment is still being written while recording
+        elif complete: segments.append((max(end - time, 0.001), offset, index["size"] - offset))
+    if len(segments) == 0: return None
+    uri = quote(name)
+    lines = ["#EXTM3U", "#EXT-X-VERSION:6", "#EXT-X-TARGETDURATION:" + str(math.ceil(max(s[0] for s in segments))), "#EXT-X-MEDIA-SEQUENCE:0"]
+    lines.append("#EXT-X-PLAYLIST-TYPE:" + ("VOD" if complete else "EVENT"))
+    # The program tables at the start of the file are prepended to every segment
+    if index["map"] is not None and index["map"] <= keyframes[0][1]: lines.append(f'#EXT-X-MAP:URI="{uri}",BYTERANGE="{index["map"]}@0"')
+    for duration, offset, length in segments:
+        lines.append(f"#EXTINF:{duration:.3f},")
+        lines.append(f"#EXT-X-BYTERANGE:{length}@{offset}")
+        lines.append(uri)
+    if complete: lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"